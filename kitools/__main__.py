@@ -2,22 +2,26 @@
 from __future__ import print_function
 
 import argparse
-import codecs
 import os
 import platform
-import subprocess
 import sys
 from threading import Thread
-from time import sleep
 
-import colorama
-from kitools import kidfu, kifwu, kiserial, kisniffer, __version__
+from kitools import __version__
 
-if platform.system() in 'Windows':
+IS_WINDOWS = platform.system() == 'Windows'
+
+if IS_WINDOWS:
     WS_PATH = 'C:\\Program Files (x86)\\Wireshark\\Wireshark-gtk.exe'
 else:
     WS_PATH = '/usr/bin/tshark'
 
+# Lock waits can't be interrupted by Ctrl+C on Windows nor on Python 2
+if IS_WINDOWS or sys.version_info[:3] < (3, 0):
+    WAIT_TIMEOUT = 0.5
+else:
+    WAIT_TIMEOUT = None
+
 LOGO = '\
 ****************************************************************************\n\
 **                              Kirale Tools                              **\n\
@@ -25,23 +29,45 @@ LOGO = '\
 '
 
 
+def int_range(name, low, high):
+    '''Return an argparse type that accepts integers between low and high'''
+
+    def check(value):
+        try:
+            num = int(value)
+        except ValueError:
+            num = None
+        if num is None or not low <= num <= high:
+            raise argparse.ArgumentTypeError(
+                '%s must be between %d and %d' % (name, low, high)
+            )
+        return num
+
+    return check
+
+
 def _get_device():
     '''Ask user to choose a port among the availalbe connected
     Kirale devices'''
+    import colorama
+    from kitools import kifwu, kiserial
+
     print('Scanning ports...', end='')
     kirale_devs = kiserial.find_devices()
     if kirale_devs:
-        print('\rAvailable Kirale devices:')
+        lines = ['\rAvailable Kirale devices:']
         for num, dev in enumerate(kirale_devs):
-            print(
+            lines.append(
                 '%s%d%s:  %s' % (colorama.Fore.GREEN, num + 1, colorama.Fore.RESET, dev)
             )
+        sys.stdout.write('\n'.join(lines) + '\n')
         # Don't ask the user if there is only one option
         if len(kirale_devs) == 1:
             return kirale_devs[0].port
         # Ask the user for port selection
         index = 0
-        while index not in range(1, len(kirale_devs) + 1):
+        num_devs = len(kirale_devs)
+        while not 1 <= index <= num_devs:
             typed = kifwu.try_input('Enter port index: ')
             if typed.isdigit():
                 index = int(typed)
@@ -52,46 +78,50 @@ def _get_device():
 
 def get_sniffer_channel():
     '''Get a valid channel from input'''
+    from kitools import kifwu
+
     channel = 0
-    while channel not in range(11, 27):
+    while not 11 <= channel <= 26:
         num = kifwu.try_input('Enter the 802.15.4 capture channel:')
         if num.isdigit():
             channel = int(num)
     return channel
 
 
-def check_port(device):
-    '''Periodically check if the device is connected.
-    Finish when disconnection is detected'''
-    while device.is_active():
-        sleep(0.1)
-    print(
-        '\n%sConnection with the port was lost.%s'
-        % (colorama.Fore.RED, colorama.Fore.RESET)
-    )
-
-
 def port_loop(device):
     '''Terminal simulation.'''
+    import colorama
+    from kitools import kifwu
+
+    prompt = '%s@%s>' % (device.mode, device.name.split('/')[-1])
+    color = colorama.Fore.CYAN
     while True:
-        command = kifwu.try_input('%s@%s>' % (device.mode, device.name.split('/')[-1]))
+        command = kifwu.try_input(prompt)
         if command:
             response = device.ksh_cmd(command)
             if response:
-                for line in response:
-                    colored = '%s%s\n' % (colorama.Fore.CYAN, line.rstrip('\n'))
-                    print(colored, end='')
+                sys.stdout.write(
+                    ''.join(color + line.rstrip('\n') + '\n' for line in response)
+                )
+                sys.stdout.flush()
             if 'reset' in command:
                 del device
                 return
 
 
+def notify_end(event, target, *args):
+    '''Run the target and set the event when it finishes'''
+    try:
+        target(*args)
+    finally:
+        event.set()
+
+
 def capture(sniffer, channel):
-    '''Capture loop.'''
-    sniffer.start(channel)
+    '''Start the capture, frames are received in the sniffer's own thread'''
+    if not sniffer.start(channel):
+        sys.exit('Unable to start the capture on channel %u.' % channel)
     print('Capture started on channel %u.' % channel)
-    while True:
-        sleep(0.1)
 
 
 def main():
@@ -114,8 +144,8 @@ def main():
     parser.add_argument(
         '--channel',
         required=False,
-        type=int,
-        choices=range(11, 27),
+        type=int_range('channel', 11, 26),
+        metavar='{11..26}',
         help='sniffer channel (802.15.4)'
     )
     parser.add_argument(
@@ -141,22 +171,22 @@ def main():
     parser.add_argument(
         '--debug',
         required=False,
-        type=int,
-        choices=range(0, 5),
+        type=int_range('debug level', 0, 4),
+        metavar='{0..4}',
         default=0,
         help='show more program output'
     )
     parser.add_argument(
         '--flashdfu',
         required=False,
-        type=lambda x: kidfu.DfuFile(x),
+        type=str,
         default=None,
         help='provide a DFU file to flash the Kirale devices by using DFU protocol'
     )
     parser.add_argument(
         '--flashkbi',
         required=False,
-        type=lambda x: kidfu.DfuFile(x),
+        type=str,
         default=None,
         help='provide a DFU file to flash the Kirale devices by using KBI protocol'
     )
@@ -170,35 +200,48 @@ def main():
     args = parser.parse_args()
 
     # Configure output encoding
-    if platform.system() not in 'Windows':
-        if sys.version_info[:3] < (3, 0):
-            sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
-        elif sys.version_info[:3] < (3, 7):
-            sys.stdout = codecs.getwriter('utf-8')(sys.stdout.detach())
-        else:
+    if not IS_WINDOWS:
+        if hasattr(sys.stdout, 'reconfigure'):
             sys.stdout.reconfigure(encoding='utf-8')
+        else:
+            import codecs
+
+            if sys.version_info[:3] < (3, 0):
+                sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
+            else:
+                sys.stdout = codecs.getwriter('utf-8')(sys.stdout.detach())
 
     # Print logo
-    colorama.deinit()
-    colorama.init()
+    import colorama
+
+    # ANSI codes only need translating for the Windows console or stripping
+    # when the output is redirected
+    if IS_WINDOWS or not sys.stdout.isatty():
+        colorama.init()
     print(colorama.Fore.BLUE + colorama.Style.BRIGHT + LOGO + colorama.Style.RESET_ALL)
 
     # Flash DFU file if provided
-    if args.flashdfu:
-        kifwu.dfu_find_and_flash(args.flashdfu, snum=args.snum)
-        sys.exit('Program finished.')
-    if args.flashkbi:
-        kifwu.kbi_find_and_flash(args.flashkbi)
+    if args.flashdfu or args.flashkbi:
+        from kitools import kidfu, kifwu
+
+        try:
+            dfu_file = kidfu.DfuFile(args.flashdfu or args.flashkbi)
+        except argparse.ArgumentTypeError as exc:
+            parser.error(str(exc))
+        if args.flashdfu:
+            kifwu.dfu_find_and_flash(dfu_file, snum=args.snum)
+        else:
+            kifwu.kbi_find_and_flash(dfu_file)
         sys.exit('Program finished.')
 
+    from kitools import kiserial, kisniffer
+
     # Configure serial port
     if not args.port:
         args.port = _get_device()
 
-    # Threads
-    threads = []
     sniffer = None
-    # Sniffer thread
+    # Sniffer
     if kisniffer.KiSniffer.is_sniffer(args.port):
         if not args.channel:
             args.channel = get_sniffer_channel()
@@ -207,9 +250,11 @@ def main():
         )
         # Live capture
         if args.live:
+            from kitools import kifwu
+
             if not args.file:
                 args.file = WS_PATH
-            while not os.path.exists(args.file):
+            while not os.path.isfile(args.file):
                 args.file = kifwu.try_input('Enter a valid path for Wireshark: ')
             name = sniffer.config_pipe_handler()
             if name:
@@ -217,6 +262,8 @@ def main():
                     wireshark_cmd = [args.file, '-i%s' % name]
                 else:
                     wireshark_cmd = [args.file, '-i%s' % name, '-k']
+                import subprocess
+
                 ws_process = subprocess.Popen(wireshark_cmd)
             else:
                 sys.exit('System/OS not supported.')
@@ -224,36 +271,40 @@ def main():
         else:
             sniffer.config_file_handler(pcap_file=args.file)
 
-        threads.append(Thread(target=capture, args=[sniffer, args.channel]))
         device = sniffer.serial_dev
+        finished = sniffer.stopped
     # Terminal thread
     else:
         device = kiserial.KiSerialTh(port_name=args.port)
         if not device.is_valid():
             sys.exit('No valid Kirale serial devices found.')
         device.debug = kiserial.KiDebug(kiserial.KiDebug.LOGS, args.debug)
-        threads.append(Thread(target=port_loop, args=[device]))
-
-    threads.append(Thread(target=check_port, args=[device]))
-    for thread in threads:
+        finished = device.stopped
+        thread = Thread(target=notify_end, args=[finished, port_loop, device])
         thread.daemon = True
         thread.start()
 
-    while True:
-        try:
-            sleep(0.5)  # Not to keep the processor busy
-            for thread in threads:
-                if not thread.is_alive():
-                    sys.exit('Program finished.')
-        except (KeyboardInterrupt, EOFError):
-            if sniffer:
-                sniffer.close()
-            else:
-                device.close()
-            if args.live:
-                ws_process.kill()
-                ws_process.wait()
-            sys.exit('\nProgram finished by user.')
+    try:
+        if sniffer:
+            capture(sniffer, args.channel)
+        # Sleep until the session ends or the port is lost
+        while not finished.wait(WAIT_TIMEOUT):
+            pass
+        if not device.is_active():
+            print(
+                '\n%sConnection with the port was lost.%s'
+                % (colorama.Fore.RED, colorama.Fore.RESET)
+            )
+        sys.exit('Program finished.')
+    except (KeyboardInterrupt, EOFError):
+        if sniffer:
+            sniffer.close()
+        else:
+            device.close()
+        if args.live:
+            ws_process.kill()
+            ws_process.wait()
+        sys.exit('\nProgram finished by user.')
 
 
 if __name__ == '__main__':
@@ -1,15 +1,18 @@
 #!/usr/bin/python
-# -*- coding: latin-1 -*-
+# -*- coding: utf-8 -*-
 '''KBI adaptation layer for kiserial'''
 
+import binascii
 import shlex
+import socket
+import string
 import struct
-from functools import reduce
+from collections import namedtuple
+from functools import partial, reduce
 from operator import xor
 from time import gmtime, strftime
 
 import colorama
-from iptools import ipv6
 
 # Frame types
 FT_RES = 0x00 << 4
@@ -34,6 +37,16 @@ RC_MEMERR = 0x05
 RC_CFGERR = 0x06
 RC_FWUERR = 0x07
 
+# Error response messages
+RCERRORS = {
+    RC_BADPAR: 'Bad parameter',
+    RC_BADCOM: 'Bad command',
+    RC_NOTALL: 'Command not allowed',
+    RC_MEMERR: 'Memory allocation error',
+    RC_CFGERR: 'Configuration settings missing',
+    RC_FWUERR: 'Firmware update error',
+}
+
 # Notification codes
 NC_PINGR = 0x00
 NC_UDP = 0x01
@@ -54,6 +67,7 @@ ROLES = {
     'sed': 5,
     'not configured': 0,
 }
+ROLENAMES = dict((val, key) for key, val in ROLES.items())
 
 # Status codes
 STATUSCODES = {
@@ -106,34 +120,140 @@ class TYP:
     ADDRL = 12
 
 
+# Precompiled packers for the multi-byte integer fields
+_S_B = struct.Struct('>B')
+_S_H = struct.Struct('>H')
+_S_L = struct.Struct('>L')
+# IPv6 address as 8 hextets
+_S_ADDR = struct.Struct('>8H')
+_DEC_STRUCTS = {1: _S_B, 2: _S_H, 4: _S_L}
+# KBI header without the checksum: length, type and code
+_S_HDR = struct.Struct('>HBB')
+
+
 def s2b(type_, str_, size=0):
-    '''String to bytearray transformation'''
-
-    if type_ is TYP.DEC:
-        sizes = {1: '>B', 2: '>H', 4: '>L'}
-        return struct.pack(sizes[size], int(str_, 10))
-    elif type_ is TYP.HEX:
-        if len(str_) % 2 == 0 and str_.startswith('0x'):
-            return bytearray.fromhex(str_.replace('0x', ''))
-    elif type_ is TYP.STR:
-        return bytearray(list(map(ord, str_)))
-    elif type_ is TYP.STRN:
-        str_bytes = bytearray(list(map(ord, str_[:size])))
-        return str_bytes + bytearray(size - len(str_bytes))
-    elif type_ is TYP.MAC:
-        return s2b(TYP.HEX, '0x' + str_.replace('-', ''))
-    elif type_ is TYP.ADDR:
-        addr = hex(ipv6.ip2long(str_.lower())).replace('0x', '').rstrip('L').zfill(32)
-        return bytearray.fromhex(addr)
-    elif type_ is TYP.ROLE:
-        return bytearray([ROLES.get(str_)])
-    elif type_ is TYP.STDATA:
-        return bytearray([STDATA.get(str_)])
+    '''String to bytes transformation'''
+
+    if type_ == TYP.DEC:
+        return _DEC_STRUCTS[size].pack(int(str_, 10))
+    elif type_ == TYP.HEX:
+        return _enc_hex(str_)
+    elif type_ == TYP.STR:
+        return _enc_str(str_)
+    elif type_ == TYP.STRN:
+        return _enc_str(str_[:size]).ljust(size, b'\x00')
+    elif type_ == TYP.MAC:
+        return _enc_mac(str_)
+    elif type_ == TYP.ADDR:
+        return _enc_addr(str_)
+    elif type_ == TYP.ROLE:
+        return _enc_role(str_)
+    elif type_ == TYP.STDATA:
+        return _enc_stdata(str_)
+
+
+# Parameter encoders for TEXT2CLI, bound to their type and size so that
+# text_to_kbi calls them directly
+def _enc_dec1(str_):
+    return _S_B.pack(int(str_, 10))
+
+
+def _enc_dec2(str_):
+    return _S_H.pack(int(str_, 10))
+
+
+def _enc_dec4(str_):
+    return _S_L.pack(int(str_, 10))
+
+
+def _enc_hex(str_):
+    if len(str_) % 2 == 0 and str_.startswith('0x'):
+        return bytearray.fromhex(str_[2:])
+
+
+def _enc_hex0x(str_):
+    # The 0x prefix is optional
+    if not str_.startswith('0x'):
+        str_ = '0x' + str_
+    return _enc_hex(str_)
+
+
+def _enc_str(str_):
+    # Python 2 input is already bytes, it is sent as typed
+    if isinstance(str_, bytes):
+        return str_
+    return str_.encode('latin-1')
+
+
+def _enc_strn32(str_):
+    return s2b(TYP.STRN, str_, 32)
+
+
+def _enc_mac(str_):
+    return _enc_hex0x(str_.replace('-', ''))
+
+
+def _pton6(str_):
+    '''Return the 16 bytes of an IPv6 address, for the Pythons without
+    socket.inet_pton (Python 2 on Windows)'''
+    if '.' in str_:
+        # Convert the IPv4 suffix to two hextets
+        head, _, ipv4 = str_.rpartition(':')
+        octets = bytearray(int(num, 10) for num in ipv4.split('.'))
+        if len(octets) != 4:
+            raise ValueError('bad IPv4 suffix')
+        str_ = '%s:%x:%x' % (head, octets[0] << 8 | octets[1], octets[2] << 8 | octets[3])
+    halves = str_.split('::')
+    hextets = halves[0].split(':') if halves[0] else []
+    if len(halves) == 2:
+        tail = halves[1].split(':') if halves[1] else []
+        hextets += ['0'] * (8 - len(hextets) - len(tail)) + tail
+    if len(halves) > 2 or len(hextets) != 8:
+        raise ValueError('bad IPv6 address')
+    for hextet in hextets:
+        if not 0 < len(hextet) <= 4 or hextet.strip(string.hexdigits):
+            raise ValueError('bad IPv6 address')
+    return _S_ADDR.pack(*[int(hextet, 16) for hextet in hextets])
+
+
+# socket.inet_pton is missing in Python 2 on Windows
+if hasattr(socket, 'inet_pton'):
+    _enc_addr = partial(socket.inet_pton, socket.AF_INET6)
+else:
+    _enc_addr = _pton6
+
+
+def _ntop6(addr):
+    '''Return the text of a 16 byte IPv6 address. The leftmost longest run
+    of zero hextets is compressed and IPv4 suffixes are shown as hextets'''
+    if len(addr) != _S_ADDR.size:
+        raise ValueError('bad IPv6 address length')
+    hextets = ['%x' % hextet for hextet in _S_ADDR.unpack(addr)]
+    start, length, run = 0, 0, 0
+    for idx, hextet in enumerate(hextets):
+        run = run + 1 if hextet == '0' else 0
+        if run > length:
+            start, length = idx - run + 1, run
+    if length > 1:
+        return '%s::%s' % (':'.join(hextets[:start]), ':'.join(hextets[start + length:]))
+    return ':'.join(hextets)
+
+
+def _enc_mlprefix(str_):
+    return _enc_addr(str_)[:8]
+
+
+def _enc_role(str_):
+    return _S_B.pack(ROLES.get(str_))
+
+
+def _enc_stdata(str_):
+    return _S_B.pack(STDATA.get(str_))
 
 
 TEXT2CLI = {
     'clear': {'cc': CC_EXEC, 'cmd': 0x00},
-    'config thver': {'cc': CC_WRIT, 'cmd': 0x01, 'params': [lambda x: s2b(TYP.DEC, x, 2)]},
+    'config thver': {'cc': CC_WRIT, 'cmd': 0x01, 'params': [_enc_dec2]},
     'show thver': {'cc': CC_READ, 'cmd': 0x01},
     'show uptime': {'cc': CC_READ, 'cmd': 0x02},
     'reset': {'cc': CC_EXEC, 'cmd': 0x03},
@@ -141,220 +261,245 @@ TEXT2CLI = {
     'config autojoin off': {'cc': CC_DELE, 'cmd': 0x04},
     'show autojoin': {'cc': CC_READ, 'cmd': 0x04},
     'show status': {'cc': CC_READ, 'cmd': 0x05},
-    'ping': {'cc': CC_EXEC, 'cmd': 0x06, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.DEC, x, 2)]},
+    'ping': {'cc': CC_EXEC, 'cmd': 0x06, 'params': [_enc_addr, _enc_dec2]},
     'ifdown': {'cc': CC_EXEC, 'cmd': 0x07},
     'ifup': {'cc': CC_EXEC, 'cmd': 0x08},
-    'config socket add': {'cc': CC_WRIT, 'cmd': 0x09, 'params': [lambda x: s2b(TYP.DEC, x, 2)], 'lastParamOptional': True},
-    'config socket del': {'cc': CC_DELE, 'cmd': 0x09, 'params': [lambda x: s2b(TYP.DEC, x, 2)]},
+    'config socket add': {'cc': CC_WRIT, 'cmd': 0x09, 'params': [_enc_dec2], 'lastParamOptional': True},
+    'config socket del': {'cc': CC_DELE, 'cmd': 0x09, 'params': [_enc_dec2]},
     'show swver': {'cc': CC_READ, 'cmd': 0x0A},
     'show hwver': {'cc': CC_READ, 'cmd': 0x0B},
     'show snum': {'cc': CC_READ, 'cmd': 0x0C},
-    'config emac': {'cc': CC_WRIT, 'cmd': 0x0D, 'params': [lambda x: s2b(TYP.MAC, x)]},
+    'config emac': {'cc': CC_WRIT, 'cmd': 0x0D, 'params': [_enc_mac]},
     'show emac': {'cc': CC_READ, 'cmd': 0x0D},
     'show eui64': {'cc': CC_READ, 'cmd': 0x0E},
     'config lowpower on': {'cc': CC_WRIT, 'cmd': 0x0F},
     'config lowpower off': {'cc': CC_DELE, 'cmd': 0x0F},
     'show lowpower': {'cc': CC_READ, 'cmd': 0x0F},
-    'config txpower': {'cc': CC_WRIT, 'cmd': 0x10, 'params': [lambda x: s2b(TYP.DEC, x, 1)]},
+    'config txpower': {'cc': CC_WRIT, 'cmd': 0x10, 'params': [_enc_dec1]},
     'show txpower': {'cc': CC_READ, 'cmd': 0x10},
-    'config panid': {'cc': CC_WRIT, 'cmd': 0x11, 'params': [lambda x: s2b(TYP.HEX, x)]},
+    'config panid': {'cc': CC_WRIT, 'cmd': 0x11, 'params': [_enc_hex]},
     'show panid': {'cc': CC_READ, 'cmd': 0x11},
-    'config channel': {'cc': CC_WRIT, 'cmd': 0x12, 'params': [lambda x: s2b(TYP.DEC, x, 1)]},
+    'config channel': {'cc': CC_WRIT, 'cmd': 0x12, 'params': [_enc_dec1]},
     'show channel': {'cc': CC_READ, 'cmd': 0x12},
-    'config xpanid': {'cc': CC_WRIT, 'cmd': 0x13, 'params': [lambda x: s2b(TYP.HEX, x)]},
-    # Moved here for sequential seek
+    'config xpanid': {'cc': CC_WRIT, 'cmd': 0x13, 'params': [_enc_hex]},
     'show xpanfilt': {'cc': CC_READ, 'cmd': 0x1F},
     'show xpanid': {'cc': CC_READ, 'cmd': 0x13},
-    'config netname': {'cc': CC_WRIT, 'cmd': 0x14, 'params': [lambda x: s2b(TYP.STR, x)]},
+    'config netname': {'cc': CC_WRIT, 'cmd': 0x14, 'params': [_enc_str]},
     'show netname': {'cc': CC_READ, 'cmd': 0x14},
-    'config mkey': {'cc': CC_WRIT, 'cmd': 0x15, 'params': [lambda x: s2b(TYP.HEX, x)]},
+    'config mkey': {'cc': CC_WRIT, 'cmd': 0x15, 'params': [_enc_hex]},
     'show mkey': {'cc': CC_READ, 'cmd': 0x15},
-    'config commcred': {'cc': CC_WRIT, 'cmd': 0x16, 'params': [lambda x: s2b(TYP.STR, x)]},
+    'config commcred': {'cc': CC_WRIT, 'cmd': 0x16, 'params': [_enc_str]},
     'show commcred': {'cc': CC_READ, 'cmd': 0x16},
-    'config joincred': {'cc': CC_WRIT, 'cmd': 0x17, 'params': [lambda x: s2b(TYP.STR, x)]},
+    'config joincred': {'cc': CC_WRIT, 'cmd': 0x17, 'params': [_enc_str]},
     'show joincred': {'cc': CC_READ, 'cmd': 0x17},
-    'config joiner add': {'cc': CC_WRIT, 'cmd': 0x18, 'params': [lambda x: s2b(TYP.MAC, x), lambda x: s2b(TYP.STR, x)]},
+    'config joiner add': {'cc': CC_WRIT, 'cmd': 0x18, 'params': [_enc_mac, _enc_str]},
     'config joiner remove all': {'cc': CC_DELE, 'cmd': 0x18},
-    'config joiner remove': {'cc': CC_DELE, 'cmd': 0x18, 'params': [lambda x: s2b(TYP.MAC, x)]},
+    'config joiner remove': {'cc': CC_DELE, 'cmd': 0x18, 'params': [_enc_mac]},
     'show joiners': {'cc': CC_READ, 'cmd': 0x18},
-    'config role': {'cc': CC_WRIT, 'cmd': 0x19, 'params': [lambda x: s2b(TYP.ROLE, x)]},
+    'config role': {'cc': CC_WRIT, 'cmd': 0x19, 'params': [_enc_role]},
     'show role': {'cc': CC_READ, 'cmd': 0x19},
     'show rloc16': {'cc': CC_READ, 'cmd': 0x1A},
     'config comm on': {'cc': CC_WRIT, 'cmd': 0x1B},
     'config comm off': {'cc': CC_DELE, 'cmd': 0x1B},
-    'config mlprefix': {'cc': CC_WRIT, 'cmd': 0x1C, 'params': [lambda x: s2b(TYP.ADDR, x)[:8]]},
+    'config mlprefix': {'cc': CC_WRIT, 'cmd': 0x1C, 'params': [_enc_mlprefix]},
     'show mlprefix': {'cc': CC_READ, 'cmd': 0x1C},
-    'config maxchild': {'cc': CC_WRIT, 'cmd': 0x1D, 'params': [lambda x: s2b(TYP.DEC, x, 1)]},
+    'config maxchild': {'cc': CC_WRIT, 'cmd': 0x1D, 'params': [_enc_dec1]},
     'show maxchild': {'cc': CC_READ, 'cmd': 0x1D},
-    'config timeout': {'cc': CC_WRIT, 'cmd': 0x1E, 'params': [lambda x: s2b(TYP.DEC, x, 4)]},
+    'config timeout': {'cc': CC_WRIT, 'cmd': 0x1E, 'params': [_enc_dec4]},
     'show timeout': {'cc': CC_READ, 'cmd': 0x1E},
-    'config xpanfilt add': {'cc': CC_WRIT, 'cmd': 0x1F, 'params': [lambda x: s2b(TYP.HEX, x)]},
+    'config xpanfilt add': {'cc': CC_WRIT, 'cmd': 0x1F, 'params': [_enc_hex]},
     'config xpanfilt remove all': {'cc': CC_DELE, 'cmd': 0x1F},
-    'config ipaddr add': {'cc': CC_WRIT, 'cmd': 0x20, 'params': [lambda x: s2b(TYP.ADDR, x)]},
-    'config ipaddr remove': {'cc': CC_DELE, 'cmd': 0x20, 'params': [lambda x: s2b(TYP.ADDR, x)]},
+    'config ipaddr add': {'cc': CC_WRIT, 'cmd': 0x20, 'params': [_enc_addr]},
+    'config ipaddr remove': {'cc': CC_DELE, 'cmd': 0x20, 'params': [_enc_addr]},
     'show ipaddr': {'cc': CC_READ, 'cmd': 0x20},
-    'config joinport': {'cc': CC_WRIT, 'cmd': 0x21, 'params': [lambda x: s2b(TYP.DEC, x, 2)]},
+    'config joinport': {'cc': CC_WRIT, 'cmd': 0x21, 'params': [_enc_dec2]},
     'show joinport': {'cc': CC_READ, 'cmd': 0x21},
     'show heui64': {'cc': CC_READ, 'cmd': 0x22},
-    'config pollrate': {'cc': CC_WRIT, 'cmd': 0x23, 'params': [lambda x: s2b(TYP.DEC, x, 4)]},
+    'config pollrate': {'cc': CC_WRIT, 'cmd': 0x23, 'params': [_enc_dec4]},
     'show pollrate': {'cc': CC_READ, 'cmd': 0x23},
     'config outband': {'cc': CC_WRIT, 'cmd': 0x24},
-    'config steering': {'cc': CC_WRIT, 'cmd': 0x25, 'params': [lambda x: s2b(TYP.STDATA, x)]},
-    'config prefix add': {'cc': CC_WRIT, 'cmd': 0x26, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.DEC, x, 1), lambda x: s2b(TYP.HEX, x)]},
-    'config prefix remove': {'cc': CC_DELE, 'cmd': 0x26, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.DEC, x, 1)]},
-    'config route add': {'cc': CC_WRIT, 'cmd': 0x27, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.DEC, x, 1), lambda x: s2b(TYP.HEX, x)]},
-    'config route remove': {'cc': CC_DELE, 'cmd': 0x27, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.DEC, x, 1)]},
-    'config service add': {'cc': CC_WRIT, 'cmd': 0x28, 'params': [lambda x: s2b(TYP.DEC, x, 4), lambda x: s2b(TYP.DEC, x, 1), lambda x: s2b(TYP.HEX, x), lambda x: s2b(TYP.DEC, x, 1), lambda x: s2b(TYP.HEX, x)]},
-    'config service remove': {'cc': CC_DELE, 'cmd': 0x28, 'params': [lambda x: s2b(TYP.DEC, x, 4), lambda x: s2b(TYP.DEC, x, 1), lambda x: s2b(TYP.HEX, x)]},
+    'config steering': {'cc': CC_WRIT, 'cmd': 0x25, 'params': [_enc_stdata]},
+    'config prefix add': {'cc': CC_WRIT, 'cmd': 0x26, 'params': [_enc_addr, _enc_dec1, _enc_hex]},
+    'config prefix remove': {'cc': CC_DELE, 'cmd': 0x26, 'params': [_enc_addr, _enc_dec1]},
+    'config route add': {'cc': CC_WRIT, 'cmd': 0x27, 'params': [_enc_addr, _enc_dec1, _enc_hex]},
+    'config route remove': {'cc': CC_DELE, 'cmd': 0x27, 'params': [_enc_addr, _enc_dec1]},
+    'config service add': {'cc': CC_WRIT, 'cmd': 0x28, 'params': [_enc_dec4, _enc_dec1, _enc_hex, _enc_dec1, _enc_hex]},
+    'config service remove': {'cc': CC_DELE, 'cmd': 0x28, 'params': [_enc_dec4, _enc_dec1, _enc_hex]},
     'show parent': {'cc': CC_READ, 'cmd': 0x29},
     'show routert': {'cc': CC_READ, 'cmd': 0x2A},
     'show ldrdata': {'cc': CC_READ, 'cmd': 0x2B},
     'show netdata': {'cc': CC_READ, 'cmd': 0x2C},
     'show stats': {'cc': CC_READ, 'cmd': 0x2D},
     'show childt': {'cc': CC_READ, 'cmd': 0x2E},
-    'netcat': {'cc': CC_EXEC,'cmd': 0x2F,'params': [lambda x: s2b(TYP.DEC, x, 2), lambda x: s2b(TYP.DEC, x, 2), lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.HEX, x)]},
-    'config hwmode': {'cc': CC_WRIT, 'cmd': 0x31, 'params': [lambda x: s2b(TYP.DEC, x, 1)]},
+    'netcat': {'cc': CC_EXEC,'cmd': 0x2F,'params': [_enc_dec2, _enc_dec2, _enc_addr, _enc_hex]},
+    'config hwmode': {'cc': CC_WRIT, 'cmd': 0x31, 'params': [_enc_dec1]},
     'show hwmode': {'cc': CC_READ, 'cmd': 0x31},
     'config led on': {'cc': CC_WRIT, 'cmd': 0x32},
     'config led off': {'cc': CC_DELE, 'cmd': 0x32},
     'show led': {'cc': CC_READ, 'cmd': 0x32},
-    'config vname': {'cc': CC_WRIT, 'cmd': 0x33, 'params': [lambda x: s2b(TYP.STR, x)]},
+    'config vname': {'cc': CC_WRIT, 'cmd': 0x33, 'params': [_enc_str]},
     'show vname': {'cc': CC_READ, 'cmd': 0x33},
-    'config vmodel': {'cc': CC_WRIT, 'cmd': 0x34, 'params': [lambda x: s2b(TYP.STR, x)]},
+    'config vmodel': {'cc': CC_WRIT, 'cmd': 0x34, 'params': [_enc_str]},
     'show vmodel': {'cc': CC_READ, 'cmd': 0x34},
     'config vdata remove': {'cc': CC_DELE, 'cmd': 0x35},
-    'config vdata': {'cc': CC_WRIT, 'cmd': 0x35, 'params': [lambda x: s2b(TYP.STR, x)]},
+    'config vdata': {'cc': CC_WRIT, 'cmd': 0x35, 'params': [_enc_str]},
     'show vdata': {'cc': CC_READ, 'cmd': 0x35},
-    'config vswver': {'cc': CC_WRIT, 'cmd': 0x36, 'params': [lambda x: s2b(TYP.STR, x)]},
+    'config vswver': {'cc': CC_WRIT, 'cmd': 0x36, 'params': [_enc_str]},
     'show vswver': {'cc': CC_READ, 'cmd': 0x36},
-    'config actstamp': {'cc': CC_WRIT, 'cmd': 0x37, 'params': [lambda x: s2b(TYP.HEX, x)]},
-    'show actstamp': {'cc': CC_READ, 'cmd': 0x37, 'params': [lambda x: s2b(TYP.HEX, x)]},
-    'nping': {'cc': CC_EXEC, 'cmd': 0x38, 'params': [lambda x: s2b(TYP.STRN, x, 32), lambda x: s2b(TYP.DEC, x, 2)]},
-    'nnetcat': {'cc': CC_EXEC,'cmd': 0x39,'params': [lambda x: s2b(TYP.DEC, x, 2), lambda x: s2b(TYP.DEC, x, 2), lambda x: s2b(TYP.STRN, x, 32), lambda x: s2b(TYP.HEX, x)]},
+    'config actstamp': {'cc': CC_WRIT, 'cmd': 0x37, 'params': [_enc_hex]},
+    'show actstamp': {'cc': CC_READ, 'cmd': 0x37, 'params': [_enc_hex]},
+    'nping': {'cc': CC_EXEC, 'cmd': 0x38, 'params': [_enc_strn32, _enc_dec2]},
+    'nnetcat': {'cc': CC_EXEC,'cmd': 0x39,'params': [_enc_dec2, _enc_dec2, _enc_strn32, _enc_hex]},
     'show services': {'cc': CC_READ, 'cmd': 0x3A},
     'config provurl remove': {'cc': CC_DELE, 'cmd': 0x3B},
-    'config provurl': {'cc': CC_WRIT, 'cmd': 0x3B, 'params': [lambda x: s2b(TYP.STR, x)]},
+    'config provurl': {'cc': CC_WRIT, 'cmd': 0x3B, 'params': [_enc_str]},
     'show provurl': {'cc': CC_READ, 'cmd': 0x3B},
     'show commsid': {'cc': CC_READ, 'cmd': 0x3C},
-    'exec pendget': {'cc': CC_EXEC, 'cmd': 0x3D, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.HEX, '0x' + x)], 'lastParamOptional': True},
-    'exec pendset': {'cc': CC_EXEC, 'cmd': 0x3E, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.HEX, '0x' + x)]},
-    'exec activeget': {'cc': CC_EXEC, 'cmd': 0x3F, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.HEX, '0x' + x)], 'lastParamOptional': True},
-    'exec activeset': {'cc': CC_EXEC, 'cmd': 0x40, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.HEX, '0x' + x)]},
-    'exec commget': {'cc': CC_EXEC, 'cmd': 0X41, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.HEX, '0x' + x)], 'lastParamOptional': True},
-    'exec commset': {'cc': CC_EXEC, 'cmd': 0X42, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.HEX, '0x' + x)]},
-    'exec panidqry': {'cc': CC_EXEC, 'cmd': 0x43, 'params': [lambda x: s2b(TYP.ADDR, x), lambda x: s2b(TYP.HEX, x), lambda x: s2b(TYP.HEX, x)]},
+    'exec pendget': {'cc': CC_EXEC, 'cmd': 0x3D, 'params': [_enc_addr, _enc_hex0x], 'lastParamOptional': True},
+    'exec pendset': {'cc': CC_EXEC, 'cmd': 0x3E, 'params': [_enc_addr, _enc_hex0x]},
+    'exec activeget': {'cc': CC_EXEC, 'cmd': 0x3F, 'params': [_enc_addr, _enc_hex0x], 'lastParamOptional': True},
+    'exec activeset': {'cc': CC_EXEC, 'cmd': 0x40, 'params': [_enc_addr, _enc_hex0x]},
+    'exec commget': {'cc': CC_EXEC, 'cmd': 0X41, 'params': [_enc_addr, _enc_hex0x], 'lastParamOptional': True},
+    'exec commset': {'cc': CC_EXEC, 'cmd': 0X42, 'params': [_enc_addr, _enc_hex0x]},
+    'exec panidqry': {'cc': CC_EXEC, 'cmd': 0x43, 'params': [_enc_addr, _enc_hex, _enc_hex]},
 
     # Thread 1.3 commands
-    'config cslch': {'cc': CC_WRIT, 'cmd': 0x64, 'params': [lambda x: s2b(TYP.DEC, x, 1)]},
+    'config cslch': {'cc': CC_WRIT, 'cmd': 0x64, 'params': [_enc_dec1]},
     'show cslch': {'cc': CC_READ, 'cmd': 0x64},
-    'config csltout': {'cc': CC_WRIT, 'cmd': 0x65, 'params': [lambda x: s2b(TYP.DEC, x, 4)]},
+    'config csltout': {'cc': CC_WRIT, 'cmd': 0x65, 'params': [_enc_dec4]},
     'show csltout': {'cc': CC_READ, 'cmd': 0x65},
-    'config cslprd': {'cc': CC_WRIT, 'cmd': 0x66, 'params': [lambda x: s2b(TYP.DEC, x, 2)]},
+    'config cslprd': {'cc': CC_WRIT, 'cmd': 0x66, 'params': [_enc_dec2]},
     'show cslprd': {'cc': CC_READ, 'cmd': 0x66},
 }
 
 
+CmdDef = namedtuple('CmdDef', 'ctype ccode params')
+
+
+def _build_trie(commands):
+    '''Return a tree of nested dicts indexed by the words of each command,
+    the CmdDef of the command is stored in its last word under the None key'''
+    trie = {}
+    for key, cmd_def in commands.items():
+        node = trie
+        for word in key.split():
+            node = node.setdefault(word, {})
+        node[None] = CmdDef(
+            FT_CMD | cmd_def['cc'], cmd_def['cmd'], tuple(cmd_def.get('params', ()))
+        )
+    return trie
+
+
+TEXT2TRIE = _build_trie(TEXT2CLI)
+
+
+# Results of text_to_kbi by command text, emptied when it grows too large
+TEXT2KBI_CACHE = {}
+TEXT2KBI_CACHE_SIZE = 256
+
+
 def text_to_kbi(txt_cmd):
-    '''Transform a text command into a (type, code, payload) tuple'''
+    '''Transform a text command into a (type, code, payload) tuple, the
+    same commands are usually sent again so the results are cached'''
+    result = TEXT2KBI_CACHE.get(txt_cmd)
+    if result is None:
+        if len(TEXT2KBI_CACHE) >= TEXT2KBI_CACHE_SIZE:
+            TEXT2KBI_CACHE.clear()
+        result = TEXT2KBI_CACHE[txt_cmd] = _text_to_kbi(txt_cmd)
+    return result
+
+
+def _text_to_kbi(txt_cmd):
     ctype, cmd = None, None
     payload = bytearray()
 
     # Combine multiple whitespaces together
     txt_cmd = shlex.split(txt_cmd)
 
-    for key in TEXT2CLI:
-        if ' '.join(txt_cmd).startswith(key):
-            # Get command definition
-            cmd_def = TEXT2CLI.get(key)
-            # Fill type and code
-            ccode = cmd_def.get('cc', None)
-            if ccode is not None:
-                ctype = FT_CMD | ccode
-            cmd = cmd_def.get('cmd', None)
-            # Get required params
-            required_params = cmd_def.get('params', [])
-            # Get received params
-            key_len = len(key.split())
-            received_params = txt_cmd[key_len:]
-            # Check if last parameter is optional
-            if cmd_def.get('params', False):
-                if len(required_params) == len(received_params) + 1:
-                    required_params = required_params[:-1]
-            # Fill payload
-            try:
-                for param in required_params:
-                    payload += param(received_params.pop(0))
-            except:
-                return None, None, None
+    # Find the longest command matching the first words
+    cmd_def, key_len = None, 0
+    node = TEXT2TRIE
+    for depth, word in enumerate(txt_cmd, 1):
+        node = node.get(word)
+        if node is None:
             break
+        if None in node:
+            cmd_def, key_len = node[None], depth
 
-    return ctype, cmd, payload
+    if cmd_def is not None:
+        # Fill type, code and required params
+        ctype, cmd, required_params = cmd_def.ctype, cmd_def.ccode, cmd_def.params
+        # Get received params
+        received_params = txt_cmd[key_len:]
+        # Check if last parameter is optional
+        if len(required_params) == len(received_params) + 1:
+            required_params = required_params[:-1]
+        # Fill payload
+        try:
+            payload = bytearray().join(
+                [param(received_params[i]) for i, param in enumerate(required_params)]
+            )
+        except:
+            return None, None, None
+
+    return ctype, cmd, bytes(payload)
+
+
+def _hexlify(bytes_):
+    '''Return the lowercase hex digits of bytes_, without prefix'''
+    return binascii.hexlify(bytes(bytes_)).decode('ascii')
+
+
+def _u16(bytes_):
+    '''Return the value of a big endian 16 bit field, truncated fields of
+    notifications are decoded as they come'''
+    if len(bytes_) == 2:
+        return _S_H.unpack_from(bytes_)[0]
+    return int(b2s(TYP.DEC, bytes_))
 
 
 def b2s(type_, bytes_, size=None):
     '''Bytearray to string transformations'''
 
-    if type_ is TYP.STR:
-        str_ = ''
-        for byte in bytes_:
-            if byte == 0:
-                break
-            str_ += chr(byte)
-        return str_
-    elif type_ is TYP.HEX:
-        str_ = ''
-        for byte in bytes_:
-            str_ += str(hex(byte)).replace('0x', '').zfill(2)
+    if type_ == TYP.STR:
+        # Same codec as s2b and the KSH interface, any byte round trips
+        return bytes(bytes_).split(b'\x00', 1)[0].decode('latin-1')
+    elif type_ == TYP.HEX:
+        str_ = _hexlify(bytes_)
         if str_:
             return '0x' + str_
         else:
             return ''
-    elif type_ is TYP.DEC:
-        dec = b2s(TYP.HEX, bytes_).replace('0x', '')
-        return str(int(dec, 16))
-    elif type_ is TYP.MAC:
-        macs = ''
-        while bytes_:
-            hex_mac = b2s(TYP.HEX, bytes_[:8]).replace('0x', '')
-            macs += '-'.join(
-                [
-                    hex_mac[0:2],
-                    hex_mac[2:4],
-                    hex_mac[4:6],
-                    hex_mac[6:8],
-                    hex_mac[8:10],
-                    hex_mac[10:12],
-                    hex_mac[12:14],
-                    hex_mac[14:16],
-                ]
-            ) + '\r\n'
-            bytes_ = bytes_[8:]
-        return macs
-    elif type_ is TYP.ADDR:
-        hex_addr = b2s(TYP.HEX, bytes_[:size])
-        int_addr = int(hex_addr.replace('0x', '').rstrip('L').ljust(32, '0'),
-                       16)
-        return ipv6.long2ip(int_addr)
-    elif type_ is TYP.ADDRL:
+    elif type_ == TYP.DEC:
+        return str(int(_hexlify(bytes_), 16))
+    elif type_ == TYP.MAC:
+        # Hex encode all the MACs at once, then split them 16 digits each
+        hex_macs = _hexlify(bytes_)
+        return ''.join(
+            '-'.join(hex_macs[j:j + 2] for j in range(i, i + 16, 2)) + '\r\n'
+            for i in range(0, len(hex_macs), 16)
+        )
+    elif type_ == TYP.ADDR:
+        return _ntop6(bytes(bytes_[:size]).ljust(16, b'\x00'))
+    elif type_ == TYP.ADDRL:
         states = {0: 'T', 1: 'R', 4: 'I'}
-        addrs = ''
-        while bytes_:
-            addrs += '[%s] ' % states.get(bytes_[0])
-            addrs += b2s(TYP.ADDR, bytes_[1:17], 16) + '\r\n'
-            bytes_ = bytes_[17:]
-        return addrs
-    elif type_ is TYP.ROLE:
-        val = int(b2s(TYP.DEC, bytes_))
-        for key in ROLES:
-            if val is ROLES[key]:
-                return key
-        return 'bad role'
-    elif type_ is TYP.STATUS:
-        status = STATUSCODES.get(int(b2s(TYP.DEC, [bytes_[0]])), 'unknown')
+        # Each entry is the address state followed by the 16 address bytes
+        addrs = []
+        for i in range(0, len(bytes_), 17):
+            addr = bytes(bytes_[i + 1:i + 17]).ljust(16, b'\x00')
+            addrs.append(
+                '[%s] %s\r\n'
+                % (states.get(bytes_[i]), _ntop6(addr))
+            )
+        return ''.join(addrs)
+    elif type_ == TYP.ROLE:
+        return ROLENAMES.get(bytes_[0], 'bad role')
+    elif type_ == TYP.STATUS:
+        status = STATUSCODES.get(bytes_[0], 'unknown')
         if 'none' in status:
-            status += NONECODES.get(int(b2s(TYP.DEC, [bytes_[1]])), 'unknown')
+            status += NONECODES.get(bytes_[1], 'unknown')
         return status
-    elif type_ is TYP.TIME:
+    elif type_ == TYP.TIME:
         uptime = struct.unpack('>I', bytes_[0:4])[0]
         utc = struct.unpack('>I', bytes_[4:8])[0]
         temperature = struct.unpack('>b', bytes_[8:9])[0]
@@ -365,7 +510,7 @@ def b2s(type_, bytes_, size=None):
         output += 'Current UTC Time : %s\r\n' % strftime('%H:%M:%S', gmtime(utc))
         output += 'MCU Temperature  : %d°C' % temperature
         return output
-    elif type_ is TYP.SERV:
+    elif type_ == TYP.SERV:
         meaning = {0x01: 'on', 0x00: 'off'}
         output = 'DHCP server: ' + meaning[bytes_[0]]
         output += '\nDNS server: ' + meaning[bytes_[1]]
@@ -373,59 +518,75 @@ def b2s(type_, bytes_, size=None):
         return output
 
 
+# Response decoders for CLI2TEXT, shared by all the commands of each type
+_b2s_dec = partial(b2s, TYP.DEC)
+_b2s_hex = partial(b2s, TYP.HEX)
+_b2s_str = partial(b2s, TYP.STR)
+_b2s_mac = partial(b2s, TYP.MAC)
+_b2s_mlprefix = partial(b2s, TYP.ADDR, size=8)
+_b2s_addrl = partial(b2s, TYP.ADDRL)
+_b2s_role = partial(b2s, TYP.ROLE)
+_b2s_status = partial(b2s, TYP.STATUS)
+_b2s_time = partial(b2s, TYP.TIME)
+_b2s_serv = partial(b2s, TYP.SERV)
+
 CLI2TEXT = {
-    (FT_RSP | RC_VALUE, 0x01): ['thver', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x02): ['uptime', lambda x: b2s(TYP.TIME, x)],
-    (FT_RSP | RC_VALUE, 0x04): ['autojoin', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x05): ['status', lambda x: b2s(TYP.STATUS, x)],
-    (FT_RSP | RC_VALUE, 0x09): ['socket', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x0A): ['swver', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x0B): ['hwver', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x0C): ['snum', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x0D): ['emac', lambda x: b2s(TYP.MAC, x)],
-    (FT_RSP | RC_VALUE, 0x0E): ['eui64', lambda x: b2s(TYP.MAC, x)],
-    (FT_RSP | RC_VALUE, 0x0F): ['lowpower', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x10): ['txpower', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x11): ['panid', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x12): ['channel', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x13): ['xpanid', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x14): ['netname', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x15): ['mkey', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x16): ['commcred', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x17): ['joincred', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x18): ['joiners', lambda x: b2s(TYP.MAC, x)],
-    (FT_RSP | RC_VALUE, 0x19): ['role', lambda x: b2s(TYP.ROLE, x)],
-    (FT_RSP | RC_VALUE, 0x1A): ['rloc16', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x1C): ['mlprefix', lambda x: b2s(TYP.ADDR, x, 8)],
-    (FT_RSP | RC_VALUE, 0x1D): ['maxchild', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x1E): ['timeout', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x1F): ['xpanfilt', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x20): ['ipaddr', lambda x: b2s(TYP.ADDRL, x)],
-    (FT_RSP | RC_VALUE, 0x21): ['joinport', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x22): ['heui64', lambda x: b2s(TYP.MAC, x)],
-    (FT_RSP | RC_VALUE, 0x23): ['pollrate', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x29): ['parent', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x2A): ['routert', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x2B): ['ldrdata', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x2C): ['netdata', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x2D): ['stats', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x2E): ['childt', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x31): ['hwmode', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x32): ['led', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x33): ['vname', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x34): ['vmodel', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x35): ['vdata', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x36): ['vswver', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x37): ['actstamp', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x3A): ['services', lambda x: b2s(TYP.SERV, x)],
-    (FT_RSP | RC_VALUE, 0x3B): ['provurl', lambda x: b2s(TYP.STR, x)],
-    (FT_RSP | RC_VALUE, 0x3C): ['commsid', lambda x: b2s(TYP.HEX, x)],
-    (FT_RSP | RC_VALUE, 0x64): ['cslch', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x65): ['csltout', lambda x: b2s(TYP.DEC, x)],
-    (FT_RSP | RC_VALUE, 0x66): ['cslprd', lambda x: b2s(TYP.DEC, x)],
+    (FT_RSP | RC_VALUE, 0x01): ['thver', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x02): ['uptime', _b2s_time],
+    (FT_RSP | RC_VALUE, 0x04): ['autojoin', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x05): ['status', _b2s_status],
+    (FT_RSP | RC_VALUE, 0x09): ['socket', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x0A): ['swver', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x0B): ['hwver', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x0C): ['snum', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x0D): ['emac', _b2s_mac],
+    (FT_RSP | RC_VALUE, 0x0E): ['eui64', _b2s_mac],
+    (FT_RSP | RC_VALUE, 0x0F): ['lowpower', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x10): ['txpower', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x11): ['panid', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x12): ['channel', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x13): ['xpanid', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x14): ['netname', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x15): ['mkey', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x16): ['commcred', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x17): ['joincred', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x18): ['joiners', _b2s_mac],
+    (FT_RSP | RC_VALUE, 0x19): ['role', _b2s_role],
+    (FT_RSP | RC_VALUE, 0x1A): ['rloc16', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x1C): ['mlprefix', _b2s_mlprefix],
+    (FT_RSP | RC_VALUE, 0x1D): ['maxchild', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x1E): ['timeout', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x1F): ['xpanfilt', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x20): ['ipaddr', _b2s_addrl],
+    (FT_RSP | RC_VALUE, 0x21): ['joinport', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x22): ['heui64', _b2s_mac],
+    (FT_RSP | RC_VALUE, 0x23): ['pollrate', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x29): ['parent', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x2A): ['routert', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x2B): ['ldrdata', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x2C): ['netdata', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x2D): ['stats', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x2E): ['childt', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x31): ['hwmode', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x32): ['led', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x33): ['vname', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x34): ['vmodel', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x35): ['vdata', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x36): ['vswver', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x37): ['actstamp', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x3A): ['services', _b2s_serv],
+    (FT_RSP | RC_VALUE, 0x3B): ['provurl', _b2s_str],
+    (FT_RSP | RC_VALUE, 0x3C): ['commsid', _b2s_hex],
+    (FT_RSP | RC_VALUE, 0x64): ['cslch', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x65): ['csltout', _b2s_dec],
+    (FT_RSP | RC_VALUE, 0x66): ['cslprd', _b2s_dec],
 }
 
 
+# All the value responses share the same type, index their parsers by code
+CLI2TEXT_BY_CODE = [CLI2TEXT.get((FT_RSP | RC_VALUE, code)) for code in range(256)]
+
+
 def kbi_to_text(ctype, cmd, payload):
     response_code = ctype & 0x0F
     # Empty response case
@@ -433,29 +594,43 @@ def kbi_to_text(ctype, cmd, payload):
         response = ''
     # Value response case
     elif response_code == RC_VALUE:
-        rsp_func = CLI2TEXT.get((ctype, cmd), None)
+        rsp_func = CLI2TEXT_BY_CODE[cmd] if ctype == FT_RSP | RC_VALUE else None
         if rsp_func:
-            response = rsp_func[1](payload).encode('latin_1').decode()
+            response = rsp_func[1](payload)
         else:
             response = 'Wrong value or parser not implemented'
-    elif response_code == RC_BADPAR:
-        response = 'Bad parameter'
-    elif response_code == RC_BADCOM:
-        response = 'Bad command'
-    elif response_code == RC_NOTALL:
-        response = 'Command not allowed'
-    elif response_code == RC_MEMERR:
-        response = 'Memory allocation error'
-    elif response_code == RC_CFGERR:
-        response = 'Configuration settings missing'
-    elif response_code == RC_FWUERR:
-        response = 'Firmware update error'
     else:
-        response = 'Unknown error'
+        response = RCERRORS.get(response_code, 'Unknown error')
 
     return response
 
 
+def checksum(data):
+    '''Return the XOR of all the bytes in data'''
+    if len(data) < 128:
+        return reduce(xor, data, 0)
+    # Long buffers: fold the data as a single integer, halving its width
+    # on each step, so the XOR runs on whole machine words instead of bytes
+    value = int(binascii.hexlify(data), 16)
+    width = 8
+    while width < len(data) * 8:
+        width <<= 1
+    while width > 8:
+        width >>= 1
+        value = (value >> width) ^ (value & ((1 << width) - 1))
+    return value
+
+
+# Colors of the KBI header fields: length, length, type, code and checksum
+FRAME_COLORS = (
+    colorama.Fore.RED,
+    colorama.Fore.RED,
+    colorama.Fore.GREEN,
+    colorama.Fore.YELLOW,
+    colorama.Fore.BLUE,
+)
+
+
 class KBICommand:
     '''Representation of a Kirale Binary Interface command.
                             KBI Command Format
@@ -483,13 +658,12 @@ class KBICommand:
         if cmd_type is not None and cmd_cmd is not None:
             self.valid = True
 
-            self.data += cmd_payload
+            self.data = bytearray(5 + len(cmd_payload))
+            self.data[5:] = cmd_payload
 
             # Fill the header
-            struct.pack_into('>H', self.data, 0, len(cmd_payload))
-            struct.pack_into('>B', self.data, 2, cmd_type)
-            struct.pack_into('>B', self.data, 3, cmd_cmd)
-            struct.pack_into('>B', self.data, 4, reduce(xor, self.data))
+            _S_HDR.pack_into(self.data, 0, len(cmd_payload), cmd_type, cmd_cmd)
+            self.data[4] = checksum(self.data)
 
     def is_valid(self):
         return self.valid
@@ -498,10 +672,10 @@ class KBICommand:
         return self.data
 
     def get_type(self):
-        return struct.unpack('>B', self.data[2:3])[0]
+        return self.data[2]
 
     def get_code(self):
-        return struct.unpack('>B', self.data[3:4])[0]
+        return self.data[3]
 
     def get_payload(self):
         return self.data[5:]
@@ -513,28 +687,12 @@ class KBICommand:
         '''Print the KBI command as colored text'''
         if len(self.data) < 5:
             return '|  |'
-        string = ''
-        string += '| %s%02x%s : %s%02x%s : %s%02x%s : %s%02x%s : %s%02x%s ' % (
-            colorama.Fore.RED,
-            self.data[0],
-            colorama.Fore.RESET,
-            colorama.Fore.RED,
-            self.data[1],
-            colorama.Fore.RESET,
-            colorama.Fore.GREEN,
-            self.data[2],
-            colorama.Fore.RESET,
-            colorama.Fore.YELLOW,
-            self.data[3],
-            colorama.Fore.RESET,
-            colorama.Fore.BLUE,
-            self.data[4],
-            colorama.Fore.RESET,
+        hex_data = _hexlify(self.data)
+        colors = FRAME_COLORS + (colorama.Fore.MAGENTA,) * (len(self.data) - 5)
+        return '| %s |' % ' : '.join(
+            '%s%s%s' % (color, hex_data[2 * i:2 * i + 2], colorama.Fore.RESET)
+            for i, color in enumerate(colors)
         )
-        for byte in self.data[5:]:
-            string += ': %s%02x%s ' % (colorama.Fore.MAGENTA, byte, colorama.Fore.RESET)
-        string += '|'
-        return string
 
 
 class KBIResponse(KBICommand):
@@ -548,18 +706,20 @@ class KBIResponse(KBICommand):
 
         # Validation
         if size > 4:
-            # Checksum
-            if reduce(xor, self.data[:4] + self.data[5:size]) is self.data[4]:
+            # Checksum, XORing the checksum byte too must cancel out
+            if checksum(self.data[:size]) == 0:
                 # Length
-                if struct.unpack('>H', self.data[0:2])[0] == size - 5:
+                if _S_H.unpack_from(self.data)[0] == size - 5:
                     self.valid = True
+        # Responses are not modified once received, slice the payload once
+        self.payload = self.data[5:]
+
+    def get_payload(self):
+        return self.payload
 
     def is_notification(self):
-        if (self.get_type() & FT_NTF) == FT_NTF:
-            return True
-        return False
+        return (self.data[2] & FT_NTF) == FT_NTF
 
-    
     def ntf_params(self):
         '''Return a key:bytes dict of the notification parameters'''
         ntf_code = self.get_type() & 0x0F
@@ -602,33 +762,33 @@ class KBIResponse(KBICommand):
             ntf_code = self.get_type() & 0x0F
             params = self.ntf_params()
             if ntf_code == NC_PINGR:
-                return '# ping reply: saddr %s id %s sq %s - %s bytes' % (
+                return '# ping reply: saddr %s id %u sq %u - %u bytes' % (
                     b2s(TYP.ADDR, params['addr'], 16),
-                    b2s(TYP.DEC, params['id'], 2),
-                    b2s(TYP.DEC, params['sq'], 2),
-                    b2s(TYP.DEC, params['num'], 2),
+                    _u16(params['id']),
+                    _u16(params['sq']),
+                    _u16(params['num']),
                 )
             elif ntf_code == NC_PINGR_N:
-                return '# ping reply: saddr %s [%s] id %s sq %s - %s bytes' % (
+                return '# ping reply: saddr %s [%s] id %u sq %u - %u bytes' % (
                     b2s(TYP.ADDR, params['addr'], 16),
                     b2s(TYP.STR, params['name']),
-                    b2s(TYP.DEC, params['id'], 2),
-                    b2s(TYP.DEC, params['sq'], 2),
-                    b2s(TYP.DEC, params['num'], 2),
+                    _u16(params['id']),
+                    _u16(params['sq']),
+                    _u16(params['num']),
                 )
             elif ntf_code == NC_UDP:
-                return '# udp rcv: saddr %s sport %s dport %s - %s bytes' % (
+                return '# udp rcv: saddr %s sport %u dport %u - %u bytes' % (
                     b2s(TYP.ADDR, params['addr'], 16),
-                    b2s(TYP.DEC, params['loc_prt'], 2),
-                    b2s(TYP.DEC, params['rem_prt'], 2),
+                    _u16(params['loc_prt']),
+                    _u16(params['rem_prt']),
                     len(params['pld']),
                 )
             elif ntf_code == NC_UDP_N:
-                return '# udp rcv: saddr %s [%s] sport %s dport %s - %s bytes' % (
+                return '# udp rcv: saddr %s [%s] sport %u dport %u - %u bytes' % (
                     b2s(TYP.ADDR, params['addr'], 16),
                     b2s(TYP.STR, params['name']),
-                    b2s(TYP.DEC, params['loc_prt'], 2),
-                    b2s(TYP.DEC, params['rem_prt'], 2),
+                    _u16(params['loc_prt']),
+                    _u16(params['rem_prt']),
                     len(params['pld']),
                 )
             elif ntf_code == NC_DSTUN:
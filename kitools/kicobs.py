@@ -1,7 +1,7 @@
 '''Kirale COBS implementation according to:
 https://tools.ietf.org/html/draft-ietf-pppext-cobs-00'''
 
-from itertools import groupby
+from binascii import hexlify
 from struct import unpack
 
 import colorama
@@ -9,11 +9,11 @@ import colorama
 
 def _enc2str(encoded):
     '''Return encoded bytes array as a string'''
-    string = '|'
-    for byte in encoded:
-        string += ' %s%02x%s :' % (colorama.Fore.CYAN, byte, colorama.Fore.RESET)
-    string += '\b|'
-    return string
+    hex_data = hexlify(bytes(encoded)).decode('ascii')
+    byte_fmt = ' %s%%s%s :' % (colorama.Fore.CYAN, colorama.Fore.RESET)
+    return '|%s\b|' % ''.join(
+        byte_fmt % hex_data[i:i + 2] for i in range(0, len(hex_data), 2)
+    )
 
 
 class Encoder:
@@ -21,38 +21,48 @@ class Encoder:
 
     def __init__(self):
         self.out = bytearray()  # Output
-        self.data = bytearray()  # Block of data
-        self.zeros = bytearray()  # Block of zeros
-
-    def _enc_step(self, code, dlen, zlen):
-        self.out += bytearray([code]) + self.data[:dlen]
-        self.data = self.data[dlen:]
-        self.zeros = self.zeros[zlen:]
 
     def encode(self, data):
         '''Applies COBS to data and stores it'''
-        blocks = groupby(data + bytearray(1), lambda x: x is 0)
-        for block in blocks:
-            # Block of data
-            if not block[0]:
-                self.data = bytearray(block[1])
-            # Block of zeros
-            else:
-                self.zeros = bytearray(block[1])
-                # The data bytes, no implicit trailing zero
-                while len(self.data) >= 0xCF:
-                    self._enc_step(0xD0, 0xD0 - 1, 0)
-                # The data bytes, plus two trailing zeroes
-                if len(self.zeros) > 1 and len(self.data) <= 0x1E:
-                    self._enc_step(0xE0 + len(self.data), len(self.data), 2)
-                # A run of (n-D0) zeroes
-                while len(self.zeros) > 15 and len(self.data) is 0:
-                    self._enc_step(0xDF, 0, 15)
-                if len(self.zeros) > 2 and len(self.data) is 0:
-                    self._enc_step(0xD0 + len(self.zeros), 0, len(self.zeros))
-                # The data bytes, plus implicit trailing zero
-                while self.zeros:
-                    self._enc_step(len(self.data) + 1, len(self.data), 1)
+        out = self.out
+        # A trailing zero closes the last block of data
+        buf = bytearray(data) + bytearray(1)
+        size = len(buf)
+        idx = 0
+        while idx < size:
+            # Block of data, followed by its block of zeros
+            start = idx
+            while buf[idx]:
+                idx += 1
+            end = idx
+            while idx < size and not buf[idx]:
+                idx += 1
+            zeros = idx - end
+            # The data bytes, no implicit trailing zero
+            while end - start >= 0xCF:
+                out.append(0xD0)
+                out += buf[start:start + 0xCF]
+                start += 0xCF
+            dlen = end - start
+            # The data bytes, plus two trailing zeroes
+            if zeros > 1 and dlen <= 0x1E:
+                out.append(0xE0 + dlen)
+                out += buf[start:end]
+                dlen = 0
+                zeros -= 2
+            # A run of (n-D0) zeroes
+            while zeros > 15 and dlen == 0:
+                out.append(0xDF)
+                zeros -= 15
+            if zeros > 2 and dlen == 0:
+                out.append(0xD0 + zeros)
+                zeros = 0
+            # The data bytes, plus implicit trailing zero
+            while zeros:
+                out.append(dlen + 1)
+                out += buf[end - dlen:end]
+                dlen = 0
+                zeros -= 1
 
     def get_data(self):
         '''Return the encoded data, with a starting 0'''
@@ -63,7 +73,7 @@ class Encoder:
 
 
 class Decoder:
-    '''Provides a method to COBS decode byte for byte.'''
+    '''Provides methods to COBS decode byte for byte or a buffer at once.'''
 
     def __init__(self):
         self.inc = bytearray()  # Input
@@ -75,62 +85,82 @@ class Decoder:
     def decode(self, byte):
         '''Applies COBS decoding byte for byte. A decoding if finished
         when the return value is different from zero.'''
+        # Python 3 int when iterating bytes, str (Python 2) or bytes otherwise
+        if isinstance(byte, int):
+            data = bytearray([byte])
+        else:
+            data = bytearray(byte)
+        return self.decode_bytes(data)[0]
+
+    def decode_bytes(self, data, start=0):
+        '''Applies COBS decoding to the bytearray data from start, until the
+        end of the data or of the message. Return the same value as decode
+        and the index of the first byte not consumed.'''
         ret = 0
-        # Python 2 transformation
-        if isinstance(byte, str):
-            byte = bytearray([byte])[0]
-        # Python 3 ascii to int
-        try:
-            byte = ord(byte)
-        except:
-            pass
-        self.inc += bytearray([byte])
-
-        # Analyze code
-        if self.remaining is 0:
-            # PPP error
-            if byte >= 0xFF:
-                ret = -1
-            # The data bytes, plus two trailing zeroes
-            elif byte >= 0xE0:
-                self.remaining = byte - 0xE0
-                self.zeros = 2
-            # A run of (n-D0) zeroes
-            elif byte > 0xD2:
-                self.zeros = byte - 0xD0
-            # Unused
-            elif byte > 0xD0:
-                ret = -1
-            # The data bytes, no implicit trailing zero
-            elif byte is 0xD0:
-                self.remaining = byte - 1
-            # The data bytes, plus implicit trailing zero
-            elif byte > 0x0:
-                self.remaining = byte - 1
-                self.zeros = 1
-            # Restart reception
+        out = self.out
+        remaining = self.remaining
+        zeros = self.zeros
+        length = self.length
+        idx = start
+        end = len(data)
+
+        while idx < end and not ret:
+            byte = data[idx]
+            # Analyze code
+            if remaining == 0:
+                idx += 1
+                # PPP error
+                if byte >= 0xFF:
+                    ret = -1
+                # The data bytes, plus two trailing zeroes
+                elif byte >= 0xE0:
+                    remaining = byte - 0xE0
+                    zeros = 2
+                # A run of (n-D0) zeroes
+                elif byte > 0xD2:
+                    zeros = byte - 0xD0
+                # Unused
+                elif byte > 0xD0:
+                    ret = -1
+                # The data bytes, no implicit trailing zero
+                elif byte == 0xD0:
+                    remaining = byte - 1
+                # The data bytes, plus implicit trailing zero
+                elif byte > 0x0:
+                    remaining = byte - 1
+                    zeros = 1
+                # A zero code byte is a frame delimiter, nothing to decode
+                else:
+                    continue
+            # Append data, as many bytes as the message may still take
             else:
-                self = Decoder()
-        # Append data
-        else:
-            self.out += bytearray([byte])
-            self.remaining -= 1
-
-        # Append zeros
-        if self.remaining is 0:
-            self.out += bytearray(self.zeros)
-            self.zeros = 0
-
-        # Extract message length
-        if self.length is None:
-            if len(self.out) >= 2:
-                self.length = unpack('>H', self.out[:2])[0] + 5
-        # Check finish
-        elif len(self.out) > self.length:
-            ret = self.length
-            self.out = self.out[:-1]
-
-        return ret
+                if length is None:
+                    num = 1
+                else:
+                    num = min(remaining, end - idx, length + 1 - len(out))
+                out += data[idx:idx + num]
+                idx += num
+                remaining -= num
+
+            # Append zeros
+            if remaining == 0:
+                out += bytearray(zeros)
+                zeros = 0
+
+            # Extract message length
+            if length is None:
+                if len(out) >= 2:
+                    length = unpack('>H', bytes(out[:2]))[0] + 5
+            # Check finish
+            elif len(out) > length:
+                ret = length
+                del out[-1]
+
+        self.inc += data[start:idx]
+        self.remaining = remaining
+        self.zeros = zeros
+        self.length = length
+        return ret, idx
 
     def get_data(self):
         '''Return the decoded data'''
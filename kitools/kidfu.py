@@ -1,9 +1,12 @@
 '''DFU helper based on https://github.com/plietar/dfuse-tool'''
 
 import argparse
+import array
 import struct
 import time
+import zlib
 
+import usb.core
 import usb.util
 
 DFU_REQUEST_SEND = 0x21
@@ -17,6 +20,9 @@ DFU_CLRSTATUS = 0x04
 DFU_GETSTATE = 0x05
 DFU_ABORT = 0x06
 
+DFU_FUNCTIONAL_DESCRIPTOR = 0x21
+DFU_BLOCK_SIZE = 64  # Transfer size when the device doesn't report one
+
 KINOS_DFU_PID = 0x0000
 
 
@@ -26,12 +32,33 @@ class DfuDevice:
         self.dev.set_configuration()
         self.cfg = self.dev.get_active_configuration()
         self.intf = self.cfg[(0, 0)]
+        self.strings = {}  # String descriptors by index
+        # Reusable sinks for the status requests, filled in place by pyusb
+        self.status_buf = array.array('B', [0] * 6)
+        self.state_buf = array.array('B', [0])
+        self.transfer_size = self._get_transfer_size()
+
+    def _get_transfer_size(self):
+        # wTransferSize from the DFU functional descriptor of the interface
+        extra = getattr(self.intf, 'extra_descriptors', None) or []
+        idx = 0
+        while idx + 1 < len(extra) and extra[idx] >= 2:
+            if extra[idx + 1] == DFU_FUNCTIONAL_DESCRIPTOR and extra[idx] >= 7:
+                size = extra[idx + 5] | (extra[idx + 6] << 8)
+                if size >= DFU_BLOCK_SIZE:
+                    return size
+                break
+            idx += extra[idx]
+        return DFU_BLOCK_SIZE
 
     def alternates(self):
         return [(self.get_string(intf.iInterface), intf) for intf in self.cfg]
 
     def get_string(self, index):
-        return usb.util.get_string(self.dev, index)
+        # String descriptors don't change, read each one only once
+        if index not in self.strings:
+            self.strings[index] = usb.util.get_string(self.dev, index)
+        return self.strings[index]
 
     def set_alternate(self, intf):
         if isinstance(intf, tuple):
@@ -55,7 +82,9 @@ class DfuDevice:
         return self.control_msg(DFU_REQUEST_RECEIVE, DFU_UPLOAD, blockNum, size)
 
     def get_status(self):
-        status = self.control_msg(DFU_REQUEST_RECEIVE, DFU_GETSTATUS, 0, 6)
+        status = self.status_buf
+        if self.control_msg(DFU_REQUEST_RECEIVE, DFU_GETSTATUS, 0, status) < 6:
+            raise usb.core.USBError('Short DFU status')
         return (
             status[0],
             status[4],
@@ -67,7 +96,9 @@ class DfuDevice:
         self.control_msg(DFU_REQUEST_SEND, DFU_CLRSTATUS, 0, None)
 
     def get_state(self):
-        return self.control_msg(DFU_REQUEST_RECEIVE, DFU_GETSTATE, 0, 1)[0]
+        if self.control_msg(DFU_REQUEST_RECEIVE, DFU_GETSTATE, 0, self.state_buf) < 1:
+            raise usb.core.USBError('Short DFU state')
+        return self.state_buf[0]
 
     def write(self, block, data):
         return self.download(block, data)
@@ -83,9 +114,11 @@ class DfuDevice:
 
         status = self.get_status()
 
+        # Wait the poll timeout requested by the device before asking again,
+        # and return as soon as it leaves the states
         while status[1] in states:
+            time.sleep(status[2] / 1000.0)
             status = self.get_status()
-            time.sleep(status[2] / 1000)
 
         return status
 
@@ -102,6 +135,10 @@ class DfuDevice:
 class KiDfuDevice(DfuDevice):
     '''Kirale DFU device'''
 
+    def __init__(self, device):
+        DfuDevice.__init__(self, device)
+        self.boot_ver = None  # Read on demand, then cached
+
     def is_boot(self):
         return self.dev.idProduct == KINOS_DFU_PID
 
@@ -109,13 +146,16 @@ class KiDfuDevice(DfuDevice):
         # Don't try to get boot ver from a runtime device
         if not self.is_boot():
             return ''
+        if self.boot_ver:
+            return self.boot_ver
         # Clear left-over errors
         if self.get_status()[1] == DfuState.DFU_ERROR:
             self.clear_status()
         # Read version
         try:
             bytes_ver = self.upload(0, 2)
-            return 'v%u.%u' % (bytes_ver[0], bytes_ver[1])
+            self.boot_ver = 'v%u.%u' % (bytes_ver[0], bytes_ver[1])
+            return self.boot_ver
         except usb.core.USBError:
             return 'v?.?'
 
@@ -140,6 +180,8 @@ class DfuFile:
 
     def __init__(self, path):
         self.data = []
+        self.blocks = []
+        self.blocks_by_size = {}
         self.dev_info = dict()
 
         try:
@@ -150,6 +192,8 @@ class DfuFile:
         with dfufile:
             file_data = dfufile.read()
             self.data = file_data[:-16]
+            # Firmware is transferred in 64 bytes blocks by default
+            self.blocks = self.get_blocks(DFU_BLOCK_SIZE)
             suffix = parse(
                 "<HHHH3sBL",
                 file_data[-16:],
@@ -159,12 +203,25 @@ class DfuFile:
                 raise argparse.ArgumentTypeError(
                     'File\'s suffix signature does not match'
                 )
+            # The suffix CRC is a CRC-32 of the rest of the file, without the
+            # final inversion
+            crc = (zlib.crc32(file_data[:-4]) & 0xFFFFFFFF) ^ 0xFFFFFFFF
+            if crc != suffix['crc']:
+                raise argparse.ArgumentTypeError('File\'s CRC does not match')
 
             self.dev_info = dict(suffix)
             del self.dev_info['signature']
             del self.dev_info['length']
             del self.dev_info['crc']
 
+    def get_blocks(self, size):
+        '''Return the firmware split in blocks of the given size'''
+        if size not in self.blocks_by_size:
+            self.blocks_by_size[size] = [
+                self.data[i : i + size] for i in range(0, len(self.data), size)
+            ]
+        return self.blocks_by_size[size]
+
 
 class DfuState:
     APP_IDLE = 0x00
@@ -1,7 +1,6 @@
 '''Kirale firmware update functions'''
 from __future__ import print_function
 
-import itertools
 import os
 import platform
 import struct
@@ -19,6 +18,9 @@ from kitools import kicmds, kidfu, kiserial
 BACKEND = None
 KIRALE_VID = 0x2DEF
 MAX_PARALLEL_DEVICES = 18
+BLOCK_NUM = struct.Struct('>H')  # Block number of the KBI firmware update
+POLL_INTERVAL = 0.25  # Seconds between USB enumerations while waiting
+IS_WINDOWS = platform.system() == 'Windows'
 
 
 if sys.version_info > (3, 0):
@@ -72,7 +74,7 @@ def backend_init():
     BACKEND = libusb1.get_backend()
     if not BACKEND:
         # Set the libusb path
-        if platform.system() in 'Windows':
+        if IS_WINDOWS:
             if '32bit' in str(platform.architecture()):
                 LIBUSB_PATH = resource_path('libusb\\MS32\\libusb-1.0.dll')
             else:
@@ -83,31 +85,34 @@ def backend_init():
         sys_exit('No USB library found.')
 
 
-def get_usb_devices():
+def get_usb_devices(custom_match=None):
     '''Return a list of connected Kirale USB devices'''
-    return usb.core.find(idVendor=KIRALE_VID, find_all=True, backend=BACKEND)
+    return usb.core.find(
+        idVendor=KIRALE_VID, find_all=True, backend=BACKEND, custom_match=custom_match
+    )
 
 
 def get_dfu_devices(size, is_boot=False, timeout=15, required=True):
     '''Return a list of connected Kirale DFU devices'''
 
+    def is_wanted(dev):
+        return (dev.idProduct == kidfu.KINOS_DFU_PID) == is_boot
+
     devs = []
-    for _ in itertools.repeat(None, timeout):
-        devs = []
-        for dev in get_usb_devices():
-            if is_boot and dev.idProduct == kidfu.KINOS_DFU_PID:
-                devs.append(dev)
-            elif not is_boot and dev.idProduct != kidfu.KINOS_DFU_PID:
-                devs.append(dev)
-            else:
-                usb.util.dispose_resources(dev)
+    polls_per_sec = int(1 / POLL_INTERVAL)
+    for poll in range(timeout * polls_per_sec):
+        # Devices in the other mode are filtered out during the enumeration
+        devs = list(get_usb_devices(custom_match=is_wanted))
 
         if len(devs) >= size:
             break
         for dev in devs:
             usb.util.dispose_resources(dev)
-        print('.', end='')
-        time.sleep(1)
+        # Keep printing a dot per second
+        if poll % polls_per_sec == 0:
+            print('.', end='')
+            sys.stdout.flush()
+        time.sleep(POLL_INTERVAL)
     print('')
 
     if required:
@@ -115,7 +120,7 @@ def get_dfu_devices(size, is_boot=False, timeout=15, required=True):
         dfus = []
         for dev in devs:
             # Detach kernel driver
-            if platform.system() not in 'Windows':
+            if not IS_WINDOWS:
                 for config in dev:
                     for i in range(config.bNumInterfaces):
                         try:
@@ -127,10 +132,26 @@ def get_dfu_devices(size, is_boot=False, timeout=15, required=True):
         return dfus
 
 
+def select_dfus(dfus, snum):
+    '''Return the DFU devices whose serial number is in snum, all if no
+    snum is given, and release the rest'''
+    if not snum:
+        return dfus
+    selected = []
+    for dfu in dfus:
+        if dfu.get_string(dfu.dev.iSerialNumber) in snum:
+            selected.append(dfu)
+        else:
+            usb.util.dispose_resources(dfu.dev)
+    return selected
+
+
 def dfu_find_and_flash(dfu_file, unattended=False, snum=None):
     '''Flash a DFU file'''
 
     backend_init()
+    if snum:
+        snum = frozenset(snum)
 
     run_dfus_selected = []
     boot_dfus_selected = []
@@ -138,15 +159,7 @@ def dfu_find_and_flash(dfu_file, unattended=False, snum=None):
     # Find run-time Kirale devices
     run_dfus = get_dfu_devices(0, is_boot=False)
     if run_dfus:
-        if not snum:
-            run_dfus_selected = run_dfus
-        else:
-            # Filter out
-            for dfu in run_dfus:
-                if dfu.get_string(dfu.dev.iSerialNumber) in snum:
-                    run_dfus_selected.append(dfu)
-                else:
-                    usb.util.dispose_resources(dfu.dev)
+        run_dfus_selected = select_dfus(run_dfus, snum)
 
         print('List of %d run-time devices:' % len(run_dfus_selected))
 
@@ -167,15 +180,7 @@ def dfu_find_and_flash(dfu_file, unattended=False, snum=None):
 
     boot_dfus = get_dfu_devices(len(run_dfus_selected), is_boot=True)
     if boot_dfus:
-        if not snum:
-            boot_dfus_selected = boot_dfus
-        else:
-            # Filter out
-            for dfu in boot_dfus:
-                if dfu.get_string(dfu.dev.iSerialNumber) in snum:
-                    boot_dfus_selected.append(dfu)
-                else:
-                    usb.util.dispose_resources(dfu.dev)
+        boot_dfus_selected = select_dfus(boot_dfus, snum)
 
         if not boot_dfus_selected:
             return
@@ -195,25 +200,16 @@ def dfu_find_and_flash(dfu_file, unattended=False, snum=None):
     results = []
     dfus = get_dfu_devices(len(boot_dfus_selected), is_boot=True)
     if dfus:
-        if not snum:
-            dfus_selected = dfus
-        else:
-            # Filter out
-            for dfu in dfus:
-                if dfu.get_string(dfu.dev.iSerialNumber) in snum:
-                    dfus_selected.append(dfu)
-                else:
-                    usb.util.dispose_resources(dfu.dev)
+        dfus_selected = select_dfus(dfus, snum)
 
         if not dfus_selected:
             return
 
-        while dfus_selected:
-            print('Remaining %d devices. ' % len(dfus_selected), end='')
-            batch = dfus_selected[:MAX_PARALLEL_DEVICES]
+        for first in range(0, len(dfus_selected), MAX_PARALLEL_DEVICES):
+            print('Remaining %d devices. ' % (len(dfus_selected) - first), end='')
+            batch = dfus_selected[first : first + MAX_PARALLEL_DEVICES]
             print('Flashing a batch of %d devices...' % len(batch))
             results += parallel_program(dfu_flash, batch, dfu_file)
-            dfus_selected = dfus_selected[MAX_PARALLEL_DEVICES:]
             for dfu in batch:
                 usb.util.dispose_resources(dfu.dev)
     else:
@@ -239,49 +235,36 @@ def flash_summary(results, start):
     print(
         'Flashed %s of %d devices.'
         % (
-            colorize(len([r for r in results if 'OK' in r]), colorama.Fore.GREEN),
+            colorize(sum(1 for r in results if 'OK' in r), colorama.Fore.GREEN),
             len(results),
         )
     )
 
 
-def dfu_flash(dfu, dfu_file, queue, pos=0):
+def dfu_flash(dfu, dfu_file, queue, progress):
     '''Flash a list of DFU devices with the given file'''
     snum = dfu.get_string(dfu.dev.iSerialNumber)
     # Clear left-over errors
     if dfu.get_status()[1] == kidfu.DfuState.DFU_ERROR:
         dfu.clear_status()
-    # Flash
-    blocks = [dfu_file.data[i : i + 64] for i in range(0, len(dfu_file.data), 64)]
-    with tqdm.get_lock():
-        progress = tqdm(
-            total=len(blocks),
-            unit='B',
-            unit_scale=64,
-            miniters=0,
-            desc=colorize(snum, colorama.Fore.CYAN),
-            position=pos,
-            dynamic_ncols=True,
-            leave=True,
-            smoothing=0
-        )
-
+    # Flash, using the largest transfer the device accepts
+    blocks = dfu_file.get_blocks(dfu.transfer_size)
+    write = dfu.write
+    wait_while_state = dfu.wait_while_state
+    busy = kidfu.DfuState.DFU_DOWNLOAD_BUSY
+    idle = kidfu.DfuState.DFU_DOWNLOAD_IDLE
     for bnum, block in enumerate(blocks):
         try:
-            dfu.write(bnum, block)
-            status = dfu.wait_while_state(kidfu.DfuState.DFU_DOWNLOAD_BUSY)
-            if status[1] != kidfu.DfuState.DFU_DOWNLOAD_IDLE:
+            write(bnum, block)
+            status = wait_while_state(busy)
+            if status[1] != idle:
                 queue.put('%s: Error %d' % (snum, status[1]))
                 return
         except usb.core.USBError:
             queue.put('%s: USB error' % snum)
             return
         with tqdm.get_lock():
-            progress.update(1)
-
-    with tqdm.get_lock():
-        progress.refresh()
-        progress.close()
+            progress.update(len(block))
 
     dfu.leave()
     status = dfu.get_status()
@@ -311,7 +294,7 @@ def kbi_find_and_flash(dfu_file):
     flash_summary(results, start)
 
 
-def kbi_flash(kidev, dfu_file, queue, pos=0):
+def kbi_flash(kidev, dfu_file, queue, progress):
     '''Flash a list of KBI devices with the given file'''
     ctype = kicmds.FT_CMD
     ccode = kicmds.CMD_FW_UP
@@ -320,27 +303,15 @@ def kbi_flash(kidev, dfu_file, queue, pos=0):
     try:
         dev = kiserial.KiSerial(kidev.port)
         # Flash
-        blocks = [dfu_file.data[i : i + 64] for i in range(0, len(dfu_file.data), 64)]
-        with tqdm.get_lock():
-            progress = tqdm(
-                total=len(blocks),
-                unit='B',
-                unit_scale=64,
-                miniters=0,
-                desc=colorize(kidev.snum, colorama.Fore.CYAN),
-                position=pos,
-                dynamic_ncols=True,
-                leave=True,
-                smoothing=0
-            )
-
+        blocks = dfu_file.blocks
         for bnum, block in enumerate(blocks):
             # Payload is the block number plus the data
-            payload = struct.pack('>H', bnum) + block
+            payload = BLOCK_NUM.pack(bnum) + block
+            kbi_req = kicmds.KBICommand(None, ctype, ccode, payload)
             # Keep sending the same block until the response matches
             retries = 5
+            delay = 0.05
             while retries:
-                kbi_req = kicmds.KBICommand(None, ctype, ccode, payload)
                 kbi_rsp, _ = dev.kbi_cmd(kbi_req)
                 if kbi_rsp.is_valid():
                     rtype = kbi_rsp.get_type()
@@ -352,12 +323,14 @@ def kbi_flash(kidev, dfu_file, queue, pos=0):
                         return
                     elif rtype == crsp_val and len(rpload) >= 2:
                         # Received block number
-                        recv_bnum = struct.unpack('>H', rpload[:2])[0]
+                        recv_bnum = BLOCK_NUM.unpack_from(rpload)[0]
                         # Block sent successfully
                         if rcode == ccode and recv_bnum == bnum:
                             break
-                # Give some time to resend the block
-                time.sleep(5)
+                # Give some time to resend the block, backing off up to 0.5 s.
+                # kbi_cmd drops any stale bytes of the failed exchange
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
                 retries -= 1
             if not retries:
                 queue.put(
@@ -365,13 +338,9 @@ def kbi_flash(kidev, dfu_file, queue, pos=0):
                 )
                 return
             with tqdm.get_lock():
-                progress.update(1)
+                progress.update(len(block))
 
         # All went good, reset the device
-        with tqdm.get_lock():
-            progress.refresh()
-            progress.close()
-        
         dev.ksh_cmd('reset')
         queue.put('%s: OK' % kidev.snum)
     except:
@@ -385,13 +354,25 @@ def parallel_program(flash_func, devices, dfu_file):
     results = []
     tqdm.monitor_interval = 0
     tqdm.set_lock(RLock())
+    # A single bar for all the devices, updated by every flashing thread
+    progress = tqdm(
+        total=len(dfu_file.data) * len(devices),
+        unit='B',
+        unit_scale=True,
+        mininterval=0.2,
+        dynamic_ncols=True,
+        leave=True,
+        smoothing=0
+    )
 
-    for pos, dev in enumerate(devices):
-        threads.append(Thread(target=flash_func, args=[dev, dfu_file, queue, pos]))
+    for dev in devices:
+        threads.append(Thread(target=flash_func, args=[dev, dfu_file, queue, progress]))
     for thread in threads:
         thread.start()
+    # Each thread posts one result, collect them as they finish
+    for _ in threads:
+        results.append(queue.get())
     for thread in threads:
         thread.join()
-        results.append(queue.get())
-    print('\n' * len(devices))
+    progress.close()
     return results
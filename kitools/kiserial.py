@@ -9,12 +9,19 @@ import serial
 from kitools import kicmds, kicobs
 from serial.tools.list_ports import comports
 
+# Elapsed times are measured with the best clock available, time.clock is
+# gone since Python 3.8
 if sys.version_info > (3, 0):
     import queue
+    from time import perf_counter
 else:
     import Queue as queue
+    from time import time as perf_counter
 
 KSHPROMPT = 'kinos@local:~$ '
+KSHPROMPT_BYTES = KSHPROMPT.encode('latin_1')
+STDOUT_LOCK = threading.Lock()  # Keeps lines of different threads apart
+MAX_PROBES = 8  # Serial ports probed at the same time by find_devices
 
 
 class KiDebug:
@@ -48,8 +55,8 @@ class KiDebug:
                     + txt
                     + colorama.Style.RESET_ALL
                 )
-                time.sleep(0.05)  #  Try to avoid stdout concurrency problems
-            sys.stdout.write(str(txt) + '\n')  #  Otherwise print makes two calls
+            with STDOUT_LOCK:
+                sys.stdout.write(str(txt) + '\n')  #  Otherwise print makes two calls
 
     def has_option(self, option):
         '''Return True if the current instance has the option activated'''
@@ -65,10 +72,13 @@ class KiSerial:
 
     def __init__(self, port_name, baud=115200, debug=KiDebug()):
         self.valid = False
+        self.snum = ''  # Read when validating the device
         self.name = port_name
         self.hex_mac = ''
         self.debug = KiDebug()
         self.bright = False
+        self.prefix = ''
+        self._build_prefix()
 
         # Determine whether the device is attached via USB or UART
         self.mode = self.KBI_MODE
@@ -85,8 +95,6 @@ class KiSerial:
             self.port = None
 
         if self.port:
-            colorama.deinit()
-            colorama.init()
             self.debug = debug
             self.run = True
             self.start()
@@ -98,21 +106,29 @@ class KiSerial:
             self.port.writeTimeout = 0
 
     def close(self):
-        '''Optional closing operations'''
-        pass
+        '''Release the serial port'''
+        if self.port:
+            self.port.close()
 
     @staticmethod
     def get_kirale_port(name, baud):
         '''Return a Serial object with the required parameters'''
         driver_error = 'A device attached to the system is not functioning.'
         try:
-            return serial.Serial(name, baudrate=baud, timeout=0.2, writeTimeout=0)
+            port = serial.Serial(name, baudrate=baud, timeout=0.2, writeTimeout=0)
         except serial.serialutil.SerialException as exc:
             if driver_error in str(exc):
                 # Retry in case of Windows driver problems
                 return KiSerial.get_kirale_port(name, baud)
             else:
                 raise exc
+        # Linux only, avoid the latency timer of USB-UART bridges like FTDI
+        if hasattr(port, 'set_low_latency_mode'):
+            try:
+                port.set_low_latency_mode(True)
+            except (IOError, ValueError):
+                pass  # Not supported by the driver
+        return port
 
     def is_valid(self):
         '''Determine if the device is a valid Kirale device'''
@@ -122,6 +138,7 @@ class KiSerial:
             snum = self.ksh_cmd('show snum') or ['']
             if snum[0].startswith('KT'):
                 self.valid = True
+                self.snum = snum[-1]
         return self.valid
 
     def is_active(self):
@@ -135,10 +152,12 @@ class KiSerial:
     def set_mac(self, hex_mac):
         '''Set the device's MAC'''
         self.hex_mac = hex_mac
+        self._build_prefix()
 
     def bright_logs(self):
         '''Set device as DUT'''
         self.bright = True
+        self._build_prefix()
 
     def flush_buffer(self):
         '''Flush input and output buffers of the serial device'''
@@ -159,18 +178,23 @@ class KiSerial:
         self.debug.print_(KiDebug.KBI, enc_cmd)
         # Send to KiNOS
         self.flush_buffer()
-        cmd_start = time.clock()
+        cmd_start = perf_counter()
         self.port.write(enc_cmd.get_data())
         # Receive response
         decoded = kicobs.Decoder()
         size = 0
-        while size is 0:
-            byte = self.port.read(1)
-            if not byte:
-                size = -2  # Read timeout
-                break
-            size = decoded.decode(byte)
-        elapsed = time.clock() - cmd_start
+        data = bytearray()
+        idx = 0
+        while size == 0:
+            # Wait for the first byte, then take everything already received
+            if idx == len(data):
+                data = bytearray(self.port.read(self.port.inWaiting() or 1))
+                idx = 0
+                if not data:
+                    size = -2  # Read timeout
+                    break
+            size, idx = decoded.decode_bytes(data, idx)
+        elapsed = perf_counter() - cmd_start
         # Print response
         self.debug.print_(KiDebug.KBI, decoded)
         # Check
@@ -205,20 +229,23 @@ class KiSerial:
         cmd_out = bytearray()
         response = []
 
-        cmd_start = time.clock()
+        cmd_start = perf_counter()
         if not no_request:
             self.port.write((cmd + '\r').encode('latin_1'))
         if no_response:
-            elapsed = time.clock() - cmd_start
+            elapsed = perf_counter() - cmd_start
             return response, elapsed
-        while KSHPROMPT.encode('latin_1') not in cmd_out:
+        scan_from = 0
+        while cmd_out.find(KSHPROMPT_BYTES, scan_from) < 0:
+            # Only the new bytes and the end of the old ones can hold the prompt
+            scan_from = max(0, len(cmd_out) - len(KSHPROMPT_BYTES) + 1)
             char = self.port.read(1)
             if not char:
                 self.handshaking_failure('Read timeout')
                 break  # Read timeout
-            rest = self.port.read(self.port.in_waiting)
-            cmd_out += char + rest
-        elapsed = time.clock() - cmd_start
+            cmd_out += char
+            cmd_out += self.port.read(self.port.in_waiting)
+        elapsed = perf_counter() - cmd_start
         cmd_out = cmd_out.decode('latin_1').replace(KSHPROMPT, '').splitlines()
         for line in cmd_out:
             if line and line[0] == '#':
@@ -246,7 +273,7 @@ class KiSerial:
         elapsed = 0
         try:
             # UART command
-            if self.mode is self.KBI_MODE:
+            if self.mode == self.KBI_MODE:
                 cmd_out = ['Syntax error']
                 kbi_req = kicmds.KBICommand(txt_cmd)
                 if kbi_req.is_valid():
@@ -284,7 +311,10 @@ class KiSerial:
         '''Keep sending the command "show <key>" until <value> is found
         in the response or <secs> seconds have passed'''
         vset = set(value)
-        for _ in itertools.repeat(None, secs):
+        deadline = time.time() + secs
+        # Ask often at first, then back off up to once per second
+        interval = 0.05
+        while True:
             rset = set(self.ksh_cmd('show %s' % key, debug_level=KiDebug.NONE))
             # Finish if value is found in the response
             if not inverse and not rset.isdisjoint(vset):
@@ -292,7 +322,10 @@ class KiSerial:
             # Finish if value is not found in the response
             if inverse and rset.isdisjoint(vset):
                 break
-            time.sleep(1)
+            if time.time() + interval > deadline:
+                break
+            time.sleep(interval)
+            interval = min(interval * 2, 1)
 
     def start_logs(self, level='all', module='all'):
         '''Enable device logs for required level and module'''
@@ -316,36 +349,43 @@ class KiSerial:
         '''Return device logs'''
         return self.logs
 
-    def ksh2str(self, cmd, color=colorama.Fore.GREEN):
-        '''Colored print of the command'''
+    def _build_prefix(self):
+        '''Build the colored port and MAC prefix of the printed commands'''
         port = colorama.Fore.CYAN
         mac = colorama.Fore.MAGENTA
         if self.bright:
-            color += colorama.Style.BRIGHT
             port += colorama.Style.BRIGHT
             mac += colorama.Style.BRIGHT
-        string = '%s%-5s%s|%s%s%s> %s%s%s' % (
+        self.prefix = '%s%-5s%s|%s%s%s> ' % (
             port,
             self.name.split('/')[-1],
             colorama.Style.RESET_ALL,
             mac,
             self.hex_mac,
             colorama.Style.RESET_ALL,
-            color,
-            cmd,
-            colorama.Style.RESET_ALL,
         )
-        return string
+
+    def ksh2str(self, cmd, color=colorama.Fore.GREEN):
+        '''Colored print of the command'''
+        if self.bright:
+            color += colorama.Style.BRIGHT
+        return '%s%s%s%s' % (self.prefix, color, cmd, colorama.Style.RESET_ALL)
 
 
 class KiSerialTh(KiSerial):
     '''This extension class makes use of threading to be able to catch logs
     and notifications in real time.'''
 
+    WRITE_GAP = 0.2  # Minimum time between two commands sent to the device
+
     def start(self):
+        # The reader blocks until data arrives, close() wakes it up
+        self.port.timeout = 1
         self.read_queue = queue.Queue()
         self.write_queue = queue.Queue()
-        self.read_thread = threading.Thread(target=self._reader)
+        # Set when the reader thread finishes, i.e. the port is lost
+        self.stopped = threading.Event()
+        self.read_thread = threading.Thread(target=self._run_reader)
         self.write_thread = threading.Thread(target=self._writer)
         # Daemon mode is useful if device is removed without closing
         self.read_thread.daemon = True
@@ -358,10 +398,22 @@ class KiSerialTh(KiSerial):
         if self.port:
             self.run = False
             self.write_queue.put(None)
+            # Not available in old pyserial versions, the read timeout applies
+            if hasattr(self.port, 'cancel_read'):
+                self.port.cancel_read()
             self.read_thread.join()
             self.write_thread.join()
             self.port.close()
 
+    def _run_reader(self):
+        '''Run the reader until it is stopped or the port fails'''
+        try:
+            self._reader()
+        except (OSError, serial.SerialException):
+            pass
+        finally:
+            self.stopped.set()
+
     def _reader(self):
         decoded = kicobs.Decoder()
         log_line = ''
@@ -371,10 +423,12 @@ class KiSerialTh(KiSerial):
         while self.run:
             data = self.port.read(self.port.inWaiting() or 1)
             # KBI
-            if self.mode is self.KBI_MODE:
-                for byte in data:
-                    size = decoded.decode(byte)
-                    if size is not 0:
+            if self.mode == self.KBI_MODE:
+                data = bytearray(data)
+                idx = 0
+                while idx < len(data):
+                    size, idx = decoded.decode_bytes(data, idx)
+                    if size != 0:
                         self.debug.print_(KiDebug.KBI, decoded)
                         kbi_rsp = kicmds.KBIResponse(decoded.get_data(), size)
                         self.debug.print_(KiDebug.KBI, kbi_rsp)
@@ -390,32 +444,48 @@ class KiSerialTh(KiSerial):
                         decoded = kicobs.Decoder()
             # KSH
             else:
-                for char in data.decode('latin_1'):
-                    if char == '#':
-                        log_start = True
+                text = data.decode('latin_1')
+                # Only the new text and the end of the old one can hold the prompt
+                scan_from = max(0, len(received_chars) - len(KSHPROMPT) + 1)
+                pos = 0
+                # Logs go from a '#' to the end of the line, the rest is response
+                while pos < len(text):
                     if log_start:
-                        if char == '\n':
-                            log_start = False
-                            self.logs.append(log_line)
-                            self.debug.print_(KiDebug.LOGS, log_line)
-                            log_line = ''
-                        else:
-                            log_line += char
+                        end = text.find('\n', pos)
+                        if end < 0:
+                            log_line += text[pos:]
+                            break
+                        log_line += text[pos:end]
+                        log_start = False
+                        self.logs.append(log_line)
+                        self.debug.print_(KiDebug.LOGS, log_line)
+                        log_line = ''
+                        pos = end + 1
                     else:
-                        received_chars += char
-                if KSHPROMPT in received_chars:
+                        end = text.find('#', pos)
+                        if end < 0:
+                            received_chars += text[pos:]
+                            break
+                        received_chars += text[pos:end]
+                        log_start = True
+                        pos = end
+                if received_chars.find(KSHPROMPT, scan_from) >= 0:
                     response = received_chars.replace(KSHPROMPT, '').splitlines()
                     self.read_queue.put(response)
                     received_chars = ''
 
     def _writer(self):
+        last_write = 0
         while self.run:
-            time.sleep(0.2)
             cmd = self.write_queue.get()
             if not cmd:
                 return
+            # Only wait if the previous command was sent too recently
+            wait = last_write + self.WRITE_GAP - time.time()
+            if wait > 0:
+                time.sleep(wait)
             # KBI
-            if self.mode is self.KBI_MODE:
+            if self.mode == self.KBI_MODE:
                 self.debug.print_(KiDebug.KBI, cmd)
                 enc_cmd = kicobs.Encoder()
                 enc_cmd.encode(cmd.get_data())
@@ -428,6 +498,7 @@ class KiSerialTh(KiSerial):
                 if cmd['no_response']:
                     self.read_queue.put([])
             self.port.write(data)
+            last_write = time.time()
 
     def ksh_cmd(self, txt_cmd, debug_level=None, no_response=False):
         '''Send a text command'''
@@ -441,10 +512,10 @@ class KiSerialTh(KiSerial):
         # Print command
         self.debug.print_(KiDebug.KSH, self.ksh2str(txt_cmd, color=colorama.Fore.GREEN))
 
-        cmd_start = time.clock()
+        cmd_start = perf_counter()
         try:
             # KBI
-            if self.mode is self.KBI_MODE:
+            if self.mode == self.KBI_MODE:
                 cmd_out = ['Syntax error']
                 kbi_req = kicmds.KBICommand(txt_cmd)
                 if kbi_req.is_valid():
@@ -456,7 +527,7 @@ class KiSerialTh(KiSerial):
                         time.sleep(0.1)
                         self.write_queue.put(kbi_req)
                         kbi_rsp = self.read_queue.get(block=True, timeout=3)
-                    elif kbi_rsp.get_code() is kbi_req.get_code():
+                    elif kbi_rsp.get_code() == kbi_req.get_code():
                         cmd_out = kbi_rsp.to_text().splitlines()
             # KSH
             else:
@@ -466,7 +537,7 @@ class KiSerialTh(KiSerial):
             cmd_out = ['Serial problem']
         except queue.Empty:
             cmd_out = ['Read timeout']
-        elapsed = time.clock() - cmd_start
+        elapsed = perf_counter() - cmd_start
 
         # Print the response
         for line in cmd_out:
@@ -512,27 +583,61 @@ class KiDevice:
         )
 
 
+def probe_port(port, desc, has_snum=None, has_br=None, has_uart=None):
+    '''Return a KiDevice if there is a Kirale device in the port that passes
+    the filters, None otherwise'''
+    device = KiSerial(port)
+    try:
+        if not device.is_valid():
+            return None
+        # The filters go from the cheapest to the ones that need commands
+        snum = device.snum
+        # UART filter
+        if has_uart is not None:
+            if has_uart != (device.mode == device.KBI_MODE):
+                return None
+        # Serial number filter
+        if has_snum is not None:
+            if snum != has_snum:
+                return None
+        # Border router filter
+        if has_br is not None:
+            is_br = 'hwmode' in ''.join(device.ksh_cmd('config'))
+            if has_br != is_br:
+                return None
+        swver = device.ksh_cmd('show swver')[-1]
+        return KiDevice(port, desc, snum, swver, device.mode)
+    finally:
+        device.close()
+
+
 def find_devices(has_snum=None, has_br=None, has_uart=None):
     '''Find connected Kirale devices and return a list of KiDevice objects'''
-    devices = []
-    for port, desc, _ in comports():
-        device = KiSerial(port)
-        if device.is_valid():
-            snum = device.ksh_cmd('show snum')[-1]
-            swver = device.ksh_cmd('show swver')[-1]
-            # Serial number filter
-            if has_snum is not None:
-                if snum != has_snum:
-                    continue
-            # Border router filter
-            if has_br is not None:
-                is_br = 'hwmode' in ''.join(device.ksh_cmd('config'))
-                if has_br != is_br:
-                    continue
-            # UART filter
-            if has_uart is not None:
-                if has_uart != (device.mode == device.KBI_MODE):
-                    continue
-            devices.append(KiDevice(port, desc, snum, swver, device.mode))
-        del device
-    return devices
+    ports = [(port, desc) for port, desc, _ in comports()]
+    # Each port is probed in its own thread, up to MAX_PROBES at a time.
+    # Results and errors keep the ports order
+    results = [None] * len(ports)
+    errors = [None] * len(ports)
+    slots = threading.BoundedSemaphore(MAX_PROBES)
+
+    def probe(index, port, desc):
+        try:
+            results[index] = probe_port(port, desc, has_snum, has_br, has_uart)
+        except Exception as exc:  # pylint: disable=broad-except
+            errors[index] = exc
+        finally:
+            slots.release()
+
+    threads = []
+    for index, (port, desc) in enumerate(ports):
+        slots.acquire()
+        thread = threading.Thread(target=probe, args=(index, port, desc))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    # Errors are raised in the caller, as when the ports were probed in turn
+    for exc in errors:
+        if exc is not None:
+            raise exc
+    return [device for device in results if device]
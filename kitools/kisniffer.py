@@ -8,15 +8,25 @@ import struct
 import threading
 import time
 
+import serial
 from kitools import kiserial  # pylint: disable=E0401
 
-if platform.system() in 'Windows':
+IS_WINDOWS = platform.system() == 'Windows'
+
+if IS_WINDOWS:
     import win32api
     import win32file
     import win32pipe
 
 SW_VER = 'Sniffer'
 
+# PCAP record header
+PCAP_REC = struct.Struct('>LLLL')
+# IEEE 802.15.4 TAP header with the FCS, RSS, LQI and channel TLVs
+TAP_HDR = struct.Struct('<BBH' + 'HHI' + 'HHf' + 'HHI' + 'HHHH')
+# RSS TLV value in dBm for each received RSSI byte (signed)
+RSS_DBM = [float(num - 256 if num > 127 else num) for num in range(256)]
+
 
 class KiraleFrameHeader:  # pylint: disable=too-few-public-methods
     '''Kirale frame header representation
@@ -44,40 +54,68 @@ class KiraleFrameHeader:  # pylint: disable=too-few-public-methods
         {'mgc': 0xC0978C97, 'fmt': '>HQ'}
     ]
 
+    # Magic number bytes to magic number and header struct
+    MAGICS = dict(
+        (struct.pack('>L', rep['mgc']), (rep['mgc'], struct.Struct(rep['fmt'])))
+        for rep in REPRS
+    )
+    # Headers with RSSI and LQI, and with the timestamp in microseconds
+    RSSI_LQI_MAGICS = (REPRS[2]['mgc'], REPRS[3]['mgc'])
+    USEC_MAGIC = REPRS[3]['mgc']
+    NO_HEADER = (None, None, None, None)
+
     def __init__(self):
         self.bytes = bytearray()
         self.mgc = None
-        self.fmt = None
+        self.hdr = None
         self.ust = False
 
-    def add_byte(self, byte):
-        '''Append a byte to the right of the header and return frame len
-         and timestamp if the header is valid'''
-        self.bytes.append(byte)
-        if len(self.bytes) == 4 and not self.fmt:
-            for frame_type in self.REPRS:
-                magic = struct.unpack_from('>L', self.bytes)[0]
-                if magic == frame_type['mgc']:
-                    self.mgc = frame_type['mgc']
-                    self.fmt = frame_type['fmt']
-                    return None, None, None, None
-            self.bytes.pop(0)
-        elif self.fmt and len(self.bytes) == (struct.Struct(self.fmt).size + 4):
-            frame_len, tstamp = struct.unpack_from(self.fmt, self.bytes[4:])
-            if (self.mgc not in [self.REPRS[2]['mgc'], self.REPRS[3]['mgc']]):
-                # Old versions doesn't bring RSSI and LQI information
-                rssi = 0
-                lqi  = 0
-            else:
-                rssi   = ( tstamp >> 56 ) & 0xFF
-                lqi    = ( tstamp >> 48 ) & 0x00FF
-            tstamp = tstamp & 0x0000FFFFFFFFFFFF
-            self.bytes = bytearray()
-            self.fmt = None
-            if (self.mgc in [self.REPRS[3]['mgc']]):
-                self.ust = True
-            return frame_len, tstamp, rssi, lqi
-        return None, None, None, None
+    def _find_magic(self, buf, start):
+        '''Return the position of the first magic number in buf from start,
+        or -1'''
+        found = [pos for pos in (buf.find(mgc, start) for mgc in self.MAGICS) if pos >= 0]
+        return min(found) if found else -1
+
+    def add_bytes(self, data, start=0):
+        '''Consume the bytes of data from start until a header is complete.
+        Return frame len, timestamp, RSSI and LQI if the header is valid, and
+        the index of the first byte not consumed'''
+        # Bytes of a header split between reads are kept until the next one,
+        # otherwise data is scanned in place
+        if self.bytes:
+            buf = self.bytes + data[start:]
+            pos = 0
+            shift = start - len(self.bytes)
+            del self.bytes[:]
+        else:
+            buf = data
+            pos = start
+            shift = 0
+        if not self.hdr:
+            found = self._find_magic(buf, pos)
+            if found < 0:
+                # The tail may be the beginning of a magic number
+                self.bytes = buf[max(pos, len(buf) - 3) :]
+                return self.NO_HEADER, len(data)
+            pos = found
+            self.mgc, self.hdr = self.MAGICS[bytes(buf[pos : pos + 4])]
+        hdr_end = pos + 4 + self.hdr.size
+        if len(buf) < hdr_end:
+            self.bytes = buf[pos:]
+            return self.NO_HEADER, len(data)
+        frame_len, tstamp = self.hdr.unpack_from(buf, pos + 4)
+        if self.mgc not in self.RSSI_LQI_MAGICS:
+            # Old versions doesn't bring RSSI and LQI information
+            rssi = 0
+            lqi  = 0
+        else:
+            rssi   = ( tstamp >> 56 ) & 0xFF
+            lqi    = ( tstamp >> 48 ) & 0x00FF
+        tstamp = tstamp & 0x0000FFFFFFFFFFFF
+        self.hdr = None
+        if self.mgc == self.USEC_MAGIC:
+            self.ust = True
+        return (frame_len, tstamp, rssi, lqi), hdr_end + shift
 
     def __str__(self):
         return ' '.join([hex(byte) for byte in self.bytes])
@@ -115,10 +153,17 @@ class KiSniffer:
         self.channel = 0
         self.handlers = []
         self.thread = None
+        # Set when the reception thread finishes, i.e. the port is lost
+        self.stopped = threading.Event()
         self.is_running = False
         self.init_ts = 0
         self.usec = 0
         self.link_type_tap = link_type_tap
+        # Pick the record format once instead of checking it for every frame
+        if link_type_tap:
+            self.build_frame = pcap_tap_record
+        else:
+            self.build_frame = pcap_record
         self.serial_dev = kiserial.KiSerial(port_name, debug=serial_debug)
         self.reset()
 
@@ -127,21 +172,23 @@ class KiSniffer:
         if not pcap_file:
             if not pcap_folder:
                 pcap_folder = os.getcwd()
-            pcap_file = '%s\\Capture_%s_%s.pcapng' % (
+            pcap_file = os.path.join(
                 pcap_folder,
-                self.serial_dev.port.name.split('/')[-1],
-                time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(time.time())),
+                'Capture_%s_%s.pcapng'
+                % (
+                    self.serial_dev.port.name.split('/')[-1],
+                    time.strftime('%Y-%m-%d_%H-%M-%S'),
+                ),
             )
         self.handlers.append(FileHandler(pcap_file, self.link_type_tap))
 
     def config_pipe_handler(self):
         '''Set up a pipe handler to store the received frames'''
         name = None
-        system = platform.system()
-        if system in 'Windows':
+        if IS_WINDOWS:
             name = r'\\.\pipe\Kirale%s' % int(time.time())
             handler = WinPipeHandler(name, self.link_type_tap)
-        elif system in 'Linux' or system in 'Darwin':
+        elif platform.system() in ('Linux', 'Darwin'):
             name = '/tmp/Kirale%d' % int(time.time())
             handler = UnixFifoHandler(name, self.link_type_tap)
         
@@ -152,7 +199,7 @@ class KiSniffer:
     def start(self, channel):
         '''Start capturing'''
         now = datetime.datetime.now()
-        self.init_ts = time.mktime(now.timetuple()) * 1000000 + now.microsecond
+        self.init_ts = int(time.mktime(now.timetuple())) * 1000000 + now.microsecond
 
         for handle in self.handlers:
             handle.start()
@@ -162,7 +209,7 @@ class KiSniffer:
         if self.channel:
             self.is_running = True
             self.serial_dev.ksh_cmd('ifup', no_response=True)
-            self.thread = threading.Thread(target=self.receive)
+            self.thread = threading.Thread(target=self._run_receive)
             self.thread.daemon = True
             self.thread.start()
             return True
@@ -181,26 +228,56 @@ class KiSniffer:
             handler.stop()
         self.handlers = []
 
+    def _run_receive(self):
+        '''Run the reception until it is stopped or the port fails'''
+        try:
+            self.receive()
+        except (OSError, serial.SerialException):
+            pass
+        finally:
+            self.stopped.set()
+
     def receive(self):
         '''Keep receiving and sending frames to the handlers'''
         header = KiraleFrameHeader()
+        # Bind the per-frame calls to locals, the handlers are fixed by now
+        add_bytes = header.add_bytes
+        read = self.serial_dev.port.read
+        in_waiting = self.serial_dev.port.inWaiting
+        build_frame = self.build_frame
+        handlers = self.handlers
+        data = bytearray()
+        idx = 0
+        written = False
         while self.is_running:
-            byte = self.serial_dev.port.read(1)
-            if not byte:
-                continue
-            frame_len, tstamp, rssi, lqi = header.add_byte(byte[0])
+            # Wait for the first byte, then take everything already received
+            if idx == len(data):
+                waiting = in_waiting()
+                # Flush the handlers once the port runs dry, not per frame
+                if written and not waiting:
+                    for handler in handlers:
+                        handler.flush()
+                    written = False
+                data = bytearray(read(waiting or 1))
+                idx = 0
+                if not data:
+                    continue
+            (frame_len, tstamp, rssi, lqi), idx = add_bytes(data, idx)
             if frame_len is not None:
-                frame_data = self.serial_dev.port.read(frame_len)
+                # The frame may be partially or fully received already
+                frame_data = bytes(data[idx : idx + frame_len])
+                idx += len(frame_data)
+                if len(frame_data) < frame_len:
+                    frame_data += read(frame_len - len(frame_data))
                 if len(frame_data) == frame_len:
                     if not header.ust:
                         self.usec = self.init_ts + tstamp * 16  # Timestamp in symbols
                     else:
                         self.usec = self.init_ts + tstamp       # Timestamp in us                        
-                    frame = PCAPFrame(
-                        frame_data, self.link_type_tap, self.usec, rssi, lqi, self.channel
-                    )
-                    for handler in self.handlers:
+                    frame = build_frame(frame_data, self.usec, rssi, lqi, self.channel)
+                    for handler in handlers:
                         handler.handle(frame)
+                    written = True
 
     def set_channel(self, channel):
         '''Set the channel if it is valid'''
@@ -229,9 +306,22 @@ class KiSniffer:
         self.serial_dev.ksh_cmd('ifdown', no_response=True)
 
 
-class PCAPFrame:  # pylint: disable=too-few-public-methods
-    '''PCAP frame representation according to Libpcap File Format'''
-    '''
+def pcap_record(frame_data, usec, rssi, lqi, channel):
+    '''Return the PCAP record bytes for DLT_IEEE802_15_4_WITHFCS, according
+    to Libpcap File Format'''
+    # pylint: disable=unused-argument
+    length = len(frame_data)
+    frame = bytearray(PCAP_REC.size + length)
+    ts_sec, ts_usec = divmod(int(usec), 1000000)
+    PCAP_REC.pack_into(frame, 0, ts_sec, ts_usec, length, length)
+    frame[PCAP_REC.size :] = frame_data
+    return bytes(frame)
+
+
+def pcap_tap_record(frame_data, usec, rssi, lqi, channel):
+    '''Return the PCAP record bytes for DLT_IEEE802_15_4_TAP, according
+    to Libpcap File Format
+
     IEEE 802.15.4 TAP Packet
         The IEEE 802.15.4 TAP Packet consists of the TAP Header, zero or more 
         TLV fields, the PHY payload (PSDU), and optional FCS bytes. All data 
@@ -306,43 +396,22 @@ class PCAPFrame:  # pylint: disable=too-few-public-methods
             |          Channel number       |  Channel page |    padding    |
             +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     '''
-
-    def __init__(self, frame_data, link_type_tap, usec, rssi, lqi, channel):
-        if link_type_tap:
-            len_tap = 4 + 4 * 8
-        else:
-            len_tap = 0
-        header_libpacp = struct.pack(
-            '>LLLL',
-            int(usec / 1000000),            # ts_sec
-            int(usec % 1000000),            # ts_usec
-            int(len(frame_data) + len_tap), # incl_len
-            int(len(frame_data) + len_tap), # orig_len
-        )
-        if link_type_tap:
-            header_15_4_tap = struct.pack('<BBH', 0, 0, len_tap)
-            # FCS TLV
-            tlvs_15_4_tap = struct.pack('<HHI', 0, 1, 1)
-            # RSS TLV
-            tlvs_15_4_tap += struct.pack('<HHf', 1, 4, float(self._convert_uint8_to_int8(rssi))) 
-            # LQI TLV
-            tlvs_15_4_tap += struct.pack('<HHI', 10, 1, lqi)
-            # Channel TLV
-            tlvs_15_4_tap += struct.pack('<HHHH', 3, 3, channel, 0)
-            self.frame = header_libpacp + header_15_4_tap + tlvs_15_4_tap + frame_data
-        else:
-            self.frame = header_libpacp + frame_data
-
-    def get_bytes(self):
-        '''Return the full frame as bytearray'''
-        return self.frame
-
-    @staticmethod
-    def _convert_uint8_to_int8(num):
-        if num > 127:
-            return (256 - num) * (-1)
-        else:
-            return num
+    length = TAP_HDR.size + len(frame_data)
+    # Both headers and the data are packed into a single buffer
+    frame = bytearray(PCAP_REC.size + length)
+    ts_sec, ts_usec = divmod(int(usec), 1000000)
+    PCAP_REC.pack_into(frame, 0, ts_sec, ts_usec, length, length)
+    TAP_HDR.pack_into(
+        frame,
+        PCAP_REC.size,
+        0, 0, TAP_HDR.size,                 # Header
+        0, 1, 1,                            # FCS TLV
+        1, 4, RSS_DBM[rssi],                # RSS TLV
+        10, 1, lqi,                         # LQI TLV
+        3, 3, channel, 0,                   # Channel TLV
+    )
+    frame[PCAP_REC.size + TAP_HDR.size :] = frame_data
+    return bytes(frame)
 
 
 PCAP_HDR = {
@@ -379,11 +448,32 @@ PCAP_HDR_BYTES_2 = struct.pack(
     PCAP_HDR['link_type_2'],
 )
 
-class FileHandler:
+class FrameHandler:
+    '''Base PCAP frame handler. KiSniffer passes the PCAP record bytes of
+    each frame to handle(), and calls flush() once the serial port runs dry'''
+
+    def start(self):
+        '''Start the handler'''
+        pass
+
+    def handle(self, frame):
+        '''Process the PCAP record bytes of a frame'''
+        pass
+
+    def flush(self):
+        '''Pass on the buffered frames'''
+        pass
+
+    def stop(self):
+        '''Stop the handler'''
+        pass
+
+
+class FileHandler(FrameHandler):
     '''PCAP frame handler that saves capture data to a file.'''
 
     def __init__(self, file_name, link_type_tap):
-        self.file_ = open(file_name, 'wb')
+        self.file_ = open(file_name, 'wb', 65536)
         self.link_type_tap = link_type_tap
 
     def start(self):
@@ -395,29 +485,35 @@ class FileHandler:
 
     def handle(self, frame):
         '''Write the frame to the file'''
-        self.file_.write(frame.get_bytes())
-        self.file_.flush()  # Interactive file update
+        self.file_.write(frame)
+
+    def flush(self):
+        '''Interactive file update'''
+        self.file_.flush()
 
     def stop(self):
         '''Close the file'''
         self.file_.close()
 
 
-class WinPipeHandler:
+class WinPipeHandler(FrameHandler):
     '''Windows handler for Wireshark pipe'''
 
+    PIPE_BUFFER = 65536
+
     def __init__(self, name, link_type_tap):
         self.pipe = win32pipe.CreateNamedPipe(
             name,
             win32pipe.PIPE_ACCESS_OUTBOUND,
             win32pipe.PIPE_TYPE_BYTE | win32pipe.PIPE_WAIT,
             1,
-            65536,
-            65536,
+            self.PIPE_BUFFER,
+            self.PIPE_BUFFER,
             1000,
             None,
         )
         self.link_type_tap = link_type_tap
+        self.pending = bytearray()
 
     def start(self):
         '''Start the handler'''
@@ -428,20 +524,29 @@ class WinPipeHandler:
             win32file.WriteFile(self.pipe, PCAP_HDR_BYTES_2)            
 
     def handle(self, frame):
-        '''Pass the frame bytes to the pipe'''
-        try:
-            win32file.WriteFile(self.pipe, frame.get_bytes())
-        except Exception:  # pywintypes.error
-            pass
+        '''Buffer the frame bytes, write them once the pipe buffer is full'''
+        self.pending += frame
+        if len(self.pending) >= self.PIPE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        '''Pass the buffered frames to the pipe in a single write'''
+        if self.pending:
+            try:
+                win32file.WriteFile(self.pipe, bytes(self.pending))
+            except Exception:  # pywintypes.error
+                pass
+            self.pending = bytearray()
 
     def stop(self):
         '''Stop the handler'''
+        self.flush()
         if win32file.FlushFileBuffers(self.pipe):
             if win32pipe.DisconnectNamedPipe(self.pipe):
                 win32api.CloseHandle(self.pipe)
 
 
-class UnixFifoHandler:
+class UnixFifoHandler(FrameHandler):
     '''Unix handler for Wireshark fifo'''
 
     def __init__(self, name, link_type_tap):
@@ -466,7 +571,13 @@ class UnixFifoHandler:
     def handle(self, frame):
         '''Pass the frame bytes to the fifo'''
         try:
-            self.fifo.write(frame.get_bytes())
+            self.fifo.write(frame)
+        except Exception:
+            pass
+
+    def flush(self):
+        '''Pass the buffered frames to the fifo'''
+        try:
             self.fifo.flush()
         except Exception:
             pass
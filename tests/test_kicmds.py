@@ -0,0 +1,47 @@
+'''Tests for the KBI text/bytes conversions'''
+import unittest
+
+from kitools import kicmds
+from kitools.kicmds import TYP
+
+
+class TestStrings(unittest.TestCase):
+    '''String parameters'''
+
+    def test_str_round_trip(self):
+        '''Strings set with s2b come back unchanged from b2s'''
+        for text in (u'KiNOS', u'r\xe9seau', u'\xff\xa0\xe9'):
+            self.assertEqual(kicmds.b2s(TYP.STR, kicmds.s2b(TYP.STR, text)), text)
+
+    def test_byte_strings_unchanged(self):
+        '''Byte strings, the Python 2 input, are sent as they are'''
+        typed = b'r\xc3\xa9seau'
+        self.assertEqual(kicmds.s2b(TYP.STR, typed), typed)
+        self.assertEqual(kicmds.s2b(TYP.STRN, typed, 16), typed.ljust(16, b'\x00'))
+        self.assertEqual(kicmds.s2b(TYP.STRN, typed, 4), typed[:4])
+
+    def test_str_stops_at_nul(self):
+        '''Strings end at the first NUL byte'''
+        self.assertEqual(kicmds.b2s(TYP.STR, bytearray(b'net\x00name')), u'net')
+
+
+class TestHex(unittest.TestCase):
+    '''Hex parameters'''
+
+    def test_optional_0x_prefix(self):
+        '''TLV parameters are accepted with and without the 0x prefix'''
+        payload = b'\xfd' + b'\x00' * 14 + b'\x01' + b'\x0e\x08'
+        expected = (kicmds.FT_CMD | kicmds.CC_EXEC, 0x3D, payload)
+        for tlvs in ('0e08', '0x0e08'):
+            cmd = 'exec pendget fd00::1 %s' % tlvs
+            self.assertEqual(kicmds.text_to_kbi(cmd), expected)
+
+    def test_mac_prefix(self):
+        '''MAC parameters are accepted with and without the 0x prefix'''
+        mac = bytearray(b'\x00\x11\x22\x33\x44\x55\x66\x77')
+        self.assertEqual(kicmds.s2b(TYP.MAC, '00-11-22-33-44-55-66-77'), mac)
+        self.assertEqual(kicmds.s2b(TYP.MAC, '0x0011223344556677'), mac)
+
+
+if __name__ == '__main__':
+    unittest.main()